@@ -96,17 +96,27 @@
     :license: BSD, see LICENSE for more details.
 """
 import re
+import sys
 import uuid
 import posixpath
 
 from pprint import pformat
+from operator import itemgetter
+from itertools import chain, islice
+from threading import Lock
+from timeit import default_timer
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
 
 from werkzeug.urls import url_encode, url_quote, url_join
 from werkzeug.utils import redirect, format_string
 from werkzeug.exceptions import HTTPException, NotFound, MethodNotAllowed
 from werkzeug._internal import _get_environ, _encode_idna
 from werkzeug._compat import itervalues, iteritems, to_unicode, to_bytes, \
-     text_type, string_types, native_string_result, \
+     text_type, string_types, integer_types, native_string_result, \
      implements_to_string, wsgi_decoding_dance
 from werkzeug.datastructures import ImmutableDict, MultiDict
 
@@ -207,6 +217,254 @@ def parse_rule(rule):
         yield None, None, remaining
 
 
+#: parse results shared by all maps, see :func:`_parse_rule_cached` and
+#: :func:`_parse_converter_args_cached`.
+_parse_cache_limit = 4096
+_rule_parse_cache = {}
+_converter_args_parse_cache = {}
+_slash_regex_cache = {}
+
+_slash = ord('/')
+_slash_categories = frozenset([sre_parse.CATEGORY_NOT_DIGIT,
+                               sre_parse.CATEGORY_NOT_SPACE,
+                               sre_parse.CATEGORY_NOT_WORD])
+_repeat_ops = frozenset(op for op in (
+    sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT,
+    getattr(sre_parse, 'POSSESSIVE_REPEAT', None)) if op is not None)
+
+
+def _parse_rule_cached(rule):
+    """Like :func:`parse_rule` but returns a tuple and remembers the result
+    for rule strings that were parsed before.  Maps created from rule
+    factories often contain the same rule strings many times.
+
+    :internal:
+    """
+    rv = _rule_parse_cache.get(rule)
+    if rv is None:
+        rv = tuple(parse_rule(rule))
+        if len(_rule_parse_cache) >= _parse_cache_limit:
+            _rule_parse_cache.clear()
+        _rule_parse_cache[rule] = rv
+    return rv
+
+
+def _parse_converter_args_cached(argstr):
+    """Like :func:`parse_converter_args` but remembers the results.
+
+    :internal:
+    """
+    rv = _converter_args_parse_cache.get(argstr)
+    if rv is None:
+        rv = parse_converter_args(argstr)
+        if len(_converter_args_parse_cache) >= _parse_cache_limit:
+            _converter_args_parse_cache.clear()
+        _converter_args_parse_cache[argstr] = rv
+    args, kwargs = rv
+    return args, dict(kwargs)
+
+
+def _charset_matches_slash(items):
+    """Checks if a character set of a parsed regular expression contains a
+    slash.  Unknown items are assumed to contain one.
+
+    :internal:
+    """
+    negate = found = False
+    for op, av in items:
+        if op == sre_parse.NEGATE:
+            negate = True
+        elif op == sre_parse.LITERAL:
+            found = found or av == _slash
+        elif op == sre_parse.RANGE:
+            found = found or av[0] <= _slash <= av[1]
+        elif op == sre_parse.CATEGORY:
+            found = found or av in _slash_categories
+        else:
+            return True
+    return found != negate
+
+
+def _pattern_matches_slash(pattern):
+    """Checks if a parsed regular expression can match a slash.  Parts the
+    check does not know are assumed to match one.
+
+    :internal:
+    """
+    for op, av in pattern:
+        if op == sre_parse.LITERAL:
+            if av == _slash:
+                return True
+        elif op == sre_parse.NOT_LITERAL:
+            if av != _slash:
+                return True
+        elif op == sre_parse.IN:
+            if _charset_matches_slash(av):
+                return True
+        elif op in _repeat_ops:
+            if _pattern_matches_slash(av[2]):
+                return True
+        elif op == sre_parse.SUBPATTERN:
+            if _pattern_matches_slash(av[-1]):
+                return True
+        elif op == sre_parse.BRANCH:
+            if any(_pattern_matches_slash(x) for x in av[1]):
+                return True
+        # assertions and backreferences do not match characters of their
+        # own, everything else (like the dot) may match a slash.
+        elif op not in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT,
+                        sre_parse.GROUPREF):
+            return True
+    return False
+
+
+def _regex_matches_slash(regex):
+    """Checks if a regular expression of a converter can match a slash.
+    If in doubt it assumes that it can.
+
+    :internal:
+    """
+    rv = _slash_regex_cache.get(regex)
+    if rv is None:
+        try:
+            rv = _pattern_matches_slash(sre_parse.parse(regex))
+        except Exception:
+            rv = True
+        if len(_slash_regex_cache) >= _parse_cache_limit:
+            _slash_regex_cache.clear()
+        _slash_regex_cache[regex] = rv
+    return rv
+
+
+def _get_server_name(environ):
+    """Returns the host (with the port if it's not the default port) the
+    WSGI environment was requested for.
+
+    :internal:
+    """
+    if 'HTTP_HOST' in environ:
+        return environ['HTTP_HOST']
+    rv = environ['SERVER_NAME']
+    if (environ['wsgi.url_scheme'], environ['SERVER_PORT']) not \
+       in (('https', '443'), ('http', '80')):
+        rv += ':' + environ['SERVER_PORT']
+    return rv
+
+
+def _get_slots_state(self):
+    """Returns the values of the slots of an object, and of its instance
+    dict if a subclass has one, as dict.  Classes with slots use this as
+    `__getstate__` because pickle protocols before 2 can't pickle them
+    otherwise.
+
+    :internal:
+    """
+    rv = dict(getattr(self, '__dict__', ()))
+    for cls in type(self).__mro__:
+        for name in cls.__dict__.get('__slots__', ()):
+            if name not in ('__dict__', '__weakref__') and \
+               hasattr(self, name):
+                rv[name] = getattr(self, name)
+    return rv
+
+
+def _set_slots_state(self, state):
+    """The `__setstate__` counterpart of :func:`_get_slots_state`.
+
+    :internal:
+    """
+    for name, value in iteritems(state):
+        setattr(self, name, value)
+
+
+#: the types of converted values that the match cache can share between
+#: requests.  Exact types only, subclasses could add mutable state.
+_immutable_types = frozenset((text_type, bytes, float, complex, bool,
+                              type(None), uuid.UUID) + integer_types)
+
+
+def _is_immutable(value):
+    """Checks if a converted value can be shared between requests.
+
+    :internal:
+    """
+    if type(value) in (tuple, frozenset):
+        return all(_is_immutable(item) for item in value)
+    return type(value) in _immutable_types
+
+
+def _insort_rule(rules, rule, key):
+    """Inserts a rule into a list of rules sorted by `key` after all rules
+    with an equal key, just like appending and sorting again would do.
+
+    :internal:
+    """
+    value = key(rule)
+    lo = 0
+    hi = len(rules)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if value < key(rules[mid]):
+            hi = mid
+        else:
+            lo = mid + 1
+    rules.insert(lo, rule)
+
+
+def _merge_rules(a, b, positions):
+    """Merges two lists of rules that are sorted by their positions into
+    one sorted list.  `positions` maps the ids of the rules to their
+    positions.
+
+    :internal:
+    """
+    rv = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if positions[id(a[i])] < positions[id(b[j])]:
+            rv.append(a[i])
+            i += 1
+        else:
+            rv.append(b[j])
+            j += 1
+    rv.extend(a[i:])
+    rv.extend(b[j:])
+    return rv
+
+
+def _split_disjoint_runs(rules):
+    """Splits a list of sorted rules into runs of consecutive rules where no
+    two rules can match the same URL because the static text before their
+    first converters differs (neither is a prefix of the other).  The order
+    of the rules within such a run does not change what matches.
+
+    :internal:
+    """
+    runs = []
+    run = []
+    literals = set()
+    covered = set()
+    for rule in rules:
+        literal = []
+        for is_dynamic, data in rule._trace:
+            if is_dynamic:
+                break
+            literal.append(data)
+        literal = u''.join(literal)
+        heads = [literal[:idx] for idx in range(len(literal) + 1)]
+        if literal in covered or any(x in literals for x in heads):
+            runs.append(run)
+            run = []
+            literals = set()
+            covered = set()
+        run.append(rule)
+        literals.add(literal)
+        covered.update(heads)
+    if run:
+        runs.append(run)
+    return runs
+
+
 class RoutingException(Exception):
     """Special exceptions that require the application to redirect, notifying
     about missing urls, etc.
@@ -242,6 +500,10 @@ class RequestAliasRedirect(RoutingException):
         self.matched_values = matched_values
 
 
+#: returned by :meth:`Rule._match` instead of raising :exc:`RequestSlash`
+_slash_missing = object()
+
+
 class BuildError(RoutingException, LookupError):
     """Raised if the build system cannot find a URL for an endpoint with the
     values provided.
@@ -417,6 +679,176 @@ class RuleTemplateFactory(RuleFactory):
                 )
 
 
+class _PathMatch(object):
+    """The result of :meth:`_PathMatcher.search`.  Like a regex match object
+    it returns the value of a group of the rule's regular expression by its
+    index.
+
+    :internal:
+    """
+    __slots__ = ('group',)
+
+    def __init__(self, groups):
+        self.group = groups.__getitem__
+
+
+class _PathMatcher(object):
+    """Matches rules that end in path converters separated by other text,
+    like ``/<path:a>/x/<path:b>/edit`` or ``/<path:a>/<int:i>/<path:b>``,
+    without the lazy ``.*?`` of the regular expression that backtracks a lot
+    for such rules.  The tail after the last path converter is anchored at
+    the end of the URL and the values in between are split at the first
+    occurrence of each separator that leaves a valid value, which gives the
+    same result as the regular expression in linear time.
+
+    The separators and the tail are tuples in the form ``(regex, literal,
+    first_slash, slashes, groups)``.  The regular expressions of separators
+    only match if a value follows them.  `literal` is the separator as
+    string if it's static, otherwise it contains converters that can't
+    match slashes between static text with slashes.  Those converters can
+    only match one part of the URL, which is found from the position of the
+    first slash of the separator (`first_slash`) and the number of slashes
+    in it (`slashes`).  `groups` maps the groups of the rule's regular
+    expression to the groups of the separator's.
+
+    :internal:
+    """
+    __slots__ = ('regex', 'head_regex', 'head_groups', 'variables',
+                 'separators', 'tail', 'suffix_group')
+    __getstate__ = _get_slots_state
+    __setstate__ = _set_slots_state
+
+    def __init__(self, regex, head_regex, head_groups, variables,
+                 separators, tail, suffix_group):
+        self.regex = regex
+        self.head_regex = head_regex
+        self.head_groups = head_groups
+        self.variables = variables
+        self.separators = separators
+        self.tail = tail
+        self.suffix_group = suffix_group
+
+    def search(self, path):
+        # most rules are ruled out by the part before the path converters,
+        # the regular expression of the rule can't match either then.
+        m = self.head_regex.match(path)
+        if m is None:
+            return
+        start = m.end()
+
+        # the dollar sign of the regular expression also matches before a
+        # trailing newline.  If both ends give a split the regular
+        # expression finds the one with the shorter values first.
+        rv = self._split(path, start, len(path))
+        if path.endswith(u'\n'):
+            other = self._split(path, start, len(path) - 1)
+            if other is not None and (rv is None or other[0] < rv[0]):
+                rv = other
+        if rv is None:
+            return
+        ends, separators, tail, suffix = rv
+
+        groups = {}
+        for idx, head_idx in self.head_groups:
+            groups[idx] = m.group(head_idx)
+        starts = [start] + [sep.end() for sep in separators]
+        for idx, value_start, value_end in zip(self.variables, starts, ends):
+            groups[idx] = path[value_start:value_end]
+        for sep, (regex, literal, first_slash, slashes, sep_groups) in \
+                zip(separators + [tail], self.separators + (self.tail,)):
+            for idx, sep_idx in sep_groups:
+                groups[idx] = sep.group(sep_idx)
+        if suffix is not None:
+            groups[self.suffix_group] = suffix
+        return _PathMatch(groups)
+
+    def _split(self, path, start, end):
+        """Splits the path from `start` to `end` into the values and
+        returns a tuple in the form ``(ends, separators, tail, suffix)``
+        where `ends` are the positions the values end at and `separators`
+        and `tail` are the matches of the separators and the tail (`None`
+        for a static tail), or `None` if the rule doesn't match.
+        """
+        suffix = None
+        if self.suffix_group is not None:
+            suffix = u''
+            if path.endswith(u'/', 0, end):
+                suffix = u'/'
+                end -= 1
+            if path[end - 1] == u'/':
+                return
+        regex, literal, first_slash, slashes, groups = self.tail
+        tail = None
+        if literal is not None:
+            if not path.endswith(literal, start, end):
+                return
+            value_end = end - len(literal)
+        else:
+            pos = end
+            for idx in range(slashes):
+                pos = path.rfind(u'/', start, pos)
+                if pos == -1:
+                    return
+            tail = regex.match(path, pos - first_slash, end)
+            if tail is None:
+                return
+            value_end = tail.start()
+        separators = self._cut(path, 0, start, value_end, set())
+        if separators is not None:
+            ends = [sep.start() for sep in separators]
+            ends.append(value_end)
+            return ends, separators, tail, suffix
+
+    def _cut(self, path, idx, start, end, failed):
+        """Returns the matches of the separators from the one with the
+        index `idx` on if the value in front of it starts at `start` and
+        the last value ends at `end`, or `None`.  The dot of the regular
+        expression doesn't match newlines, so a value can only contain one
+        as its first character.  If the first separator before the next
+        newline doesn't lead to a match the only other choices are the
+        separators that reach the newline: right in front of it or with the
+        newline in the value of one of their converters.
+        """
+        if start >= end or path[start] == u'/':
+            return
+        if idx == len(self.separators):
+            if path.find(u'\n', start + 1, end) == -1:
+                return []
+            return
+        if (idx, start) in failed:
+            return
+
+        limit = path.find(u'\n', start + 1, end)
+        if limit == -1:
+            limit = end
+        regex, literal, first_slash, slashes, groups = self.separators[idx]
+        candidates = []
+        sep = regex.search(path, start + 1, limit)
+        if sep is not None:
+            candidates.append(sep)
+        if limit < end:
+            if literal is not None:
+                positions = [limit - len(literal)]
+            else:
+                positions = []
+                pos = limit
+                for count in range(slashes):
+                    pos = path.rfind(u'/', start + 1, pos)
+                    if pos == -1:
+                        break
+                    positions.append(pos - first_slash)
+            for pos in sorted(positions):
+                if pos > start:
+                    sep = regex.match(path, pos, end)
+                    if sep is not None and sep.end() >= limit:
+                        candidates.append(sep)
+        for sep in candidates:
+            rv = self._cut(path, idx + 1, sep.end(), end, failed)
+            if rv is not None:
+                return [sep] + rv
+        failed.add((idx, start))
+
+
 @implements_to_string
 class Rule(RuleFactory):
     """A Rule represents one URL pattern.  There are some options for `Rule`
@@ -560,7 +992,9 @@ class Rule(RuleFactory):
             self.arguments = set(map(str, defaults))
         else:
             self.arguments = set()
-        self._trace = self._converters = self._regex = self._weights = None
+        self._trace = self._converters = self._regex = None
+        self._match_groups = self._slash_group = self._builder = None
+        self._path_matcher = None
 
     def empty(self):
         """Return an unbound copy of this rule.  This can be useful if you
@@ -582,6 +1016,7 @@ class Rule(RuleFactory):
         :internal:
         """
         self.bind(self.map, rebind=True)
+        self.map._remap = self.map._resort = True
 
     def bind(self, map, rebind=False):
         """Bind the url to a map and create a regular expression based on
@@ -600,131 +1035,383 @@ class Rule(RuleFactory):
         self.compile()
 
     def get_converter(self, variable_name, converter_name, args, kwargs):
-        """Looks up the converter for the given parameter.
+        """Looks up the converter for the given parameter.  Converters with
+        the same class and arguments are shared between all rules of a map.
 
         .. versionadded:: 0.9
         """
         if not converter_name in self.map.converters:
             raise LookupError('the converter %r does not exist' % converter_name)
-        return self.map.converters[converter_name](self.map, *args, **kwargs)
+        return self.map._get_converter(self.map.converters[converter_name],
+                                       args, kwargs)
+
+    def _get_domain_rule(self):
+        """Returns the rule string for the domain part.
+
+        :internal:
+        """
+        if self.map.host_matching:
+            return self.host or ''
+        return self.subdomain or ''
+
+    def _parse(self):
+        """Parses the domain rule and the rule string.  Returns two lists
+        of ``(converter, args, kwargs, variable)`` tuples, one for the domain
+        part and one for the path.  For static parts the converter is `None`
+        and the variable is the static string.
+
+        :internal:
+        """
+        rv = []
+        for rule in (self._get_domain_rule(),
+                     self.is_leaf and self.rule or self.rule.rstrip('/')):
+            parts = []
+            for converter, arguments, variable in _parse_rule_cached(rule):
+                if converter is None:
+                    parts.append((None, (), {}, variable))
+                    continue
+                if arguments:
+                    c_args, c_kwargs = _parse_converter_args_cached(arguments)
+                else:
+                    c_args = ()
+                    c_kwargs = {}
+                parts.append((converter, c_args, c_kwargs, variable))
+            rv.append(parts)
+        return rv
 
     def compile(self):
         """Compiles the regular expression and stores it."""
         assert self.map is not None, 'rule not bound'
 
-        if self.map.host_matching:
-            domain_rule = self.host or ''
-        else:
-            domain_rule = self.subdomain or ''
+        domain_parts, path_parts = self._parse()
 
-        self._trace = []
+        trace = []
         self._converters = {}
-        self._weights = []
-        regex_parts = []
 
-        def _build_regex(rule):
-            for converter, arguments, variable in parse_rule(rule):
+        def _build_regex(parts):
+            for converter, c_args, c_kwargs, variable in parts:
                 if converter is None:
-                    regex_parts.append(re.escape(variable))
-                    self._trace.append((False, variable))
-                    for part in variable.split('/'):
-                        if part:
-                            self._weights.append((0, -len(part)))
+                    trace.append((False, variable))
                 else:
-                    if arguments:
-                        c_args, c_kwargs = parse_converter_args(arguments)
-                    else:
-                        c_args = ()
-                        c_kwargs = {}
                     convobj = self.get_converter(
                         variable, converter, c_args, c_kwargs)
-                    regex_parts.append('(?P<%s>%s)' % (variable, convobj.regex))
                     self._converters[variable] = convobj
-                    self._trace.append((True, variable))
-                    self._weights.append((1, convobj.weight))
+                    trace.append((True, variable))
                     self.arguments.add(str(variable))
 
-        _build_regex(domain_rule)
-        regex_parts.append('\\|')
-        self._trace.append((False, '|'))
-        _build_regex(self.is_leaf and self.rule or self.rule.rstrip('/'))
+        _build_regex(domain_parts)
+        trace.append((False, '|'))
+        _build_regex(path_parts)
         if not self.is_leaf:
-            self._trace.append((False, '/'))
+            trace.append((False, '/'))
+        self._trace = tuple(trace)
+
+        # the builder is created by the first build, in lazy mode the
+        # regular expression is created by the first match as well.
+        self._builder = self._regex = None
+        if not self.map.lazy_compile and not self.build_only:
+            self._compile_regex()
+
+    def _compile_regex(self):
+        """Compiles the regular expression used by :meth:`match`.
+
+        :internal:
+        """
+        regex = re.compile(u'^%s$' % self._get_regex_source(), re.UNICODE)
+
+        # look up the groups once so that matching can fetch the values
+        # by position without building a dict of all groups first.
+        groupindex = regex.groupindex
+        self._match_groups = self.map._get_match_groups(tuple(
+            (groupindex[name], str(name), converter)
+            for name, converter in iteritems(self._converters)))
+        self._slash_group = None
+        if self.strict_slashes and not self.is_leaf:
+            self._slash_group = groupindex['__suffix__']
+        self._path_matcher = self._get_path_matcher(regex)
+
+        # with lazy compiling other threads may match with the rule as soon
+        # as the regular expression is set, so that happens last.
+        self._regex = regex
+
+    def _get_path_matcher(self, regex):
+        """Returns a :class:`_PathMatcher` if the rule ends in two or more
+        path converters that can be split as described there, otherwise
+        `None`.
 
-        if self.build_only:
+        :internal:
+        """
+        trace = self._trace
+        if not self.is_leaf:
+            trace = trace[:-1]
+        domain_converters = [data for is_dynamic, data
+                             in trace[:trace.index((False, '|'))]
+                             if is_dynamic]
+
+        # merge the static parts so that dynamic and static parts alternate
+        parts = []
+        for is_dynamic, data in trace:
+            if not is_dynamic and parts and not parts[-1][0]:
+                parts[-1] = (False, parts[-1][1] + data)
+            else:
+                parts.append((is_dynamic, data))
+        for pos, (is_dynamic, data) in enumerate(parts):
+            if is_dynamic and not self._converters[data].part_isolating:
+                break
+        else:
             return
-        regex = r'^%s%s$' % (
-            u''.join(regex_parts),
-            (not self.is_leaf or not self.strict_slashes) and
-                '(?<!/)(?P<__suffix__>/?)' or ''
-        )
-        self._regex = re.compile(regex, re.UNICODE)
+        head, chain = parts[:pos], parts[pos:]
+
+        # the values in the path before the first path converter have to
+        # end at a slash, then the path converters always start at the same
+        # position no matter how the values before them are matched.  The
+        # regular expressions are checked themselves as converters can
+        # claim to be part isolating.  Without slashes in the domain part
+        # its separator is the one right before the first slash of the URL,
+        # even if the domain or the path contain more of them.
+        head_source = []
+        for idx, (is_dynamic, data) in enumerate(head):
+            if not is_dynamic:
+                head_source.append(re.escape(data))
+                continue
+            if _regex_matches_slash(self._converters[data].regex) or \
+               data not in domain_converters and (
+                   idx + 1 == len(head) or head[idx + 1][0] or
+                   u'/' not in head[idx + 1][1]):
+                return
+            head_source.append(u'(?P<%s>%s)' % (
+                data, self._converters[data].regex))
+
+        # the path converters and the text between them.  Converters that
+        # can't match slashes are allowed there if there is static text
+        # with a slash in front of them and, unless they are at the end of
+        # the rule, after them.  Then there is only one part of the URL
+        # they can match.
+        variables = []
+        separators = [[]]
+        for part in chain:
+            is_dynamic, data = part
+            if is_dynamic and not self._converters[data].part_isolating:
+                if self._converters[data].regex != PathConverter.regex or \
+                   variables and not separators[-1]:
+                    return
+                variables.append(part)
+                separators.append([])
+            else:
+                separators[-1].append(part)
+        # with a single path converter the regular expression backtracks
+        # at most once per character which is faster than splitting here.
+        if len(variables) < 2:
+            return
+        groupindex = regex.groupindex
+
+        def _get_separator(parts, is_tail):
+            sources = []
+            for idx, (is_dynamic, data) in enumerate(parts):
+                if not is_dynamic:
+                    # a newline in a separator could end a value in the
+                    # middle, which the splitter doesn't look for.
+                    if u'\n' in data:
+                        return
+                    sources.append(re.escape(data))
+                    continue
+                before = idx > 0 and parts[idx - 1]
+                after = idx + 1 < len(parts) and parts[idx + 1]
+                if _regex_matches_slash(self._converters[data].regex) or \
+                   not before or before[0] or u'/' not in before[1]:
+                    return
+                # the tail is anchored at the end, so the text after its
+                # last converter doesn't need a slash.
+                if not after and not is_tail or after and (after[0] or (
+                   u'/' not in after[1] and
+                   not (is_tail and idx + 2 == len(parts)))):
+                    return
+                sources.append(u'(?P<%s>%s)' % (
+                    data, self._converters[data].regex))
+            sep_regex = re.compile(u''.join(sources) + (
+                is_tail and u'\\Z' or u'(?=[^/])'), re.UNICODE)
+            static = [data for is_dynamic, data in parts if not is_dynamic]
+            if len(static) == len(parts):
+                return sep_regex, u''.join(static), None, None, ()
+            return (sep_regex, None, static[0].index(u'/'),
+                    sum(data.count(u'/') for data in static),
+                    tuple((groupindex[name], idx) for name, idx
+                          in iteritems(sep_regex.groupindex)))
+
+        tail = _get_separator(separators.pop(), True)
+        separators = [_get_separator(parts, False)
+                      for parts in separators[1:]]
+        if tail is None or None in separators:
+            return
+
+        head_regex = re.compile(u'^' + u''.join(head_source), re.UNICODE)
+        return _PathMatcher(
+            regex, head_regex,
+            tuple((groupindex[name], head_idx) for name, head_idx
+                  in iteritems(head_regex.groupindex)),
+            tuple(groupindex[data] for is_dynamic, data in variables),
+            tuple(separators), tail, groupindex.get('__suffix__'))
+
+    def _compile_builder(self):
+        """Prepares the parts used by :meth:`build`.  The builder is a tuple
+        ``(domain_parts, path_parts)`` where each part is a tuple in the form
+        ``(data, converter)``.  If `converter` is `None` the data is an
+        already quoted static string, otherwise it's the name of the value
+        to convert.
+
+        :internal:
+        """
+        domain_parts = []
+        path_parts = []
+        static = []
+
+        def _flush():
+            if static:
+                parts.append((url_quote(to_bytes(u''.join(static),
+                                                 self.map.charset),
+                                        safe='/:|+'), None))
+                del static[:]
+
+        parts = domain_parts
+        for is_dynamic, data in self._trace:
+            if is_dynamic:
+                _flush()
+                parts.append((data, self._converters[data]))
+            elif parts is domain_parts and data == '|':
+                _flush()
+                parts = path_parts
+            else:
+                static.append(data)
+        _flush()
+        self._builder = (tuple(domain_parts), tuple(path_parts))
+
+    def _get_regex_source(self, capture=True):
+        """Returns the regular expression for this rule without anchors.  If
+        `capture` is disabled the values are not put into groups which is
+        used by the :class:`RegexMatcher` to combine rules.
 
-    def match(self, path):
+        :internal:
+        """
+        trace = self._trace
+        if not self.is_leaf:
+            trace = trace[:-1]
+        regex_parts = []
+        for is_dynamic, data in trace:
+            if not is_dynamic:
+                regex_parts.append(re.escape(data))
+            elif capture:
+                regex_parts.append(u'(?P<%s>%s)' % (
+                    data, self._converters[data].regex))
+            else:
+                regex_parts.append(u'(?:%s)' % self._converters[data].regex)
+        if not self.is_leaf or not self.strict_slashes:
+            regex_parts.append(capture and u'(?<!/)(?P<__suffix__>/?)' or
+                               u'(?<!/)/?')
+        return u''.join(regex_parts)
+
+    def match(self, path, stats=None):
         """Check if the rule matches a given path. Path is a string in the
         form ``"subdomain|/path(method)"`` and is assembled by the map.  If
         the map is doing host matching the subdomain part will be the host
         instead.
 
         If the rule matches a dict with the converted values is returned,
-        otherwise the return value is `None`.
+        otherwise the return value is `None`.  If a :class:`MatchStats`
+        object is passed the regex search and the time spent in the
+        converters are recorded on it.
+
+        :internal:
+        """
+        rv = self._match(path, stats)
+        if rv is _slash_missing:
+            raise RequestSlash()
+        if rv is not None and self.alias and self.map.redirect_defaults:
+            raise RequestAliasRedirect(rv)
+        return rv
+
+    def _match(self, path, stats=None):
+        """Like :meth:`match` but without exceptions: if the rule requires
+        a trailing slash that is missing `_slash_missing` is returned, and
+        the values of aliases are returned like any other.
 
         :internal:
         """
         if not self.build_only:
-            m = self._regex.search(path)
+            if self._regex is None:
+                self._compile_regex()
+            if stats is not None:
+                stats.regex_searches += 1
+            if self._path_matcher is not None:
+                m = self._path_matcher.search(path)
+            else:
+                m = self._regex.search(path)
             if m is not None:
-                groups = m.groupdict()
                 # we have a folder like part of the url without a trailing
-                # slash and strict slashes enabled. raise an exception that
-                # tells the map to redirect to the same url but with a
-                # trailing slash
-                if self.strict_slashes and not self.is_leaf and \
-                   not groups.pop('__suffix__'):
-                    raise RequestSlash()
-                # if we are not in strict slashes mode we have to remove
-                # a __suffix__
-                elif not self.strict_slashes:
-                    del groups['__suffix__']
-
-                result = {}
-                for name, value in iteritems(groups):
-                    try:
-                        value = self._converters[name].to_python(value)
-                    except ValidationError:
-                        return
-                    result[str(name)] = value
+                # slash and strict slashes enabled. tell the map to redirect
+                # to the same url but with a trailing slash
+                if self._slash_group is not None and \
+                   not m.group(self._slash_group):
+                    return _slash_missing
+
+                if stats is None:
+                    result = self._to_python(m)
+                else:
+                    start = default_timer()
+                    result = self._to_python(m)
+                    stats.converter_time += default_timer() - start
+                if result is None:
+                    return
                 if self.defaults:
                     result.update(self.defaults)
 
-                if self.alias and self.map.redirect_defaults:
-                    raise RequestAliasRedirect(result)
-
                 return result
 
+    def _to_python(self, m):
+        """Converts the groups of a regex match with the converters of the
+        rule.  Returns `None` if a converter does not accept its value.
+
+        :internal:
+        """
+        result = {}
+        group = m.group
+        for idx, name, converter in self._match_groups:
+            try:
+                result[name] = converter.to_python(group(idx))
+            except ValidationError:
+                return
+        return result
+
     def build(self, values, append_unknown=True):
         """Assembles the relative url for that rule and the subdomain.
         If building doesn't work for some reasons `None` is returned.
 
         :internal:
         """
-        tmp = []
-        add = tmp.append
-        processed = set(self.arguments)
-        for is_dynamic, data in self._trace:
-            if is_dynamic:
+        if self._builder is None:
+            self._compile_builder()
+        rv = []
+        for parts in self._builder:
+            tmp = []
+            add = tmp.append
+            for data, converter in parts:
+                if converter is None:
+                    add(data)
+                    continue
                 try:
-                    add(self._converters[data].to_url(values[data]))
+                    add(converter.to_url(values[data]))
                 except ValidationError:
                     return
-                processed.add(data)
-            else:
-                add(url_quote(to_bytes(data, self.map.charset), safe='/:|+'))
-        domain_part, url = (u''.join(tmp)).split(u'|', 1)
+            rv.append(u''.join(tmp))
+        domain_part, url = rv
 
         if append_unknown:
+            for key in values:
+                if key not in self.arguments:
+                    break
+            else:
+                return domain_part, url
             query_vars = MultiDict(values)
-            for key in processed:
+            for key in self.arguments:
                 if key in query_vars:
                     del query_vars[key]
 
@@ -786,7 +1473,26 @@ class Rule(RuleFactory):
 
         :internal:
         """
-        return bool(self.arguments), -len(self._weights), self._weights
+        weights = self._get_weights()
+        return bool(self.arguments), -len(weights), weights
+
+    def _get_weights(self):
+        """Returns the weights of the static parts and converters of the
+        rule for :meth:`match_compare_key`.  They are computed from the
+        trace when needed instead of being stored on every rule.
+
+        :internal:
+        """
+        weights = []
+        split = self._trace.index((False, u'|'))
+        for idx, (is_dynamic, data) in enumerate(self._trace):
+            if is_dynamic:
+                weights.append((1, self._converters[data].weight))
+            elif idx != split:
+                for part in data.split('/'):
+                    if part:
+                        weights.append((0, -len(part)))
+        return weights
 
     def build_compare_key(self):
         """The build compare key for sorting.
@@ -796,6 +1502,14 @@ class Rule(RuleFactory):
         return self.alias and 1 or 0, -len(self.arguments), \
             -len(self.defaults or ())
 
+    def __getstate__(self):
+        # unpickling a regular expression compiles it again, so the
+        # compiled parts are left out and created on first use instead.
+        state = self.__dict__.copy()
+        state['_regex'] = state['_path_matcher'] = state['_builder'] = None
+        state['_match_groups'] = state['_slash_group'] = None
+        return state
+
     def __eq__(self, other):
         return self.__class__ is other.__class__ and \
                self._trace == other._trace
@@ -827,12 +1541,26 @@ class Rule(RuleFactory):
 
 class BaseConverter(object):
     """Base class for all converters."""
+    __slots__ = ('map',)
+    __getstate__ = _get_slots_state
+    __setstate__ = _set_slots_state
     regex = '[^/]+'
     weight = 100
 
     def __init__(self, map):
         self.map = map
 
+    @property
+    def part_isolating(self):
+        """`False` if the regular expression of the converter can match a
+        slash.  Matchers like the :class:`TrieMatcher` use this to find out
+        if a value stays within one path segment.  By default this is
+        worked out from :attr:`regex`, regular expressions that are too
+        complex for that count as matching slashes.  Subclasses can set it
+        to a fixed value instead.
+        """
+        return not _regex_matches_slash(self.regex)
+
     def to_python(self, value):
         return value
 
@@ -857,6 +1585,7 @@ class UnicodeConverter(BaseConverter):
     :param maxlength: the maximum length of the string.
     :param length: the exact length of the string.
     """
+    __slots__ = ('regex',)
 
     def __init__(self, map, minlength=1, maxlength=None, length=None):
         BaseConverter.__init__(self, map)
@@ -884,6 +1613,7 @@ class AnyConverter(BaseConverter):
     :param items: this function accepts the possible items as positional
                   arguments.
     """
+    __slots__ = ('regex',)
 
     def __init__(self, map, *items):
         BaseConverter.__init__(self, map)
@@ -899,8 +1629,10 @@ class PathConverter(BaseConverter):
 
     :param map: the :class:`Map`.
     """
+    __slots__ = ()
     regex = '[^/].*?'
     weight = 200
+    part_isolating = False
 
 
 class NumberConverter(BaseConverter):
@@ -908,6 +1640,7 @@ class NumberConverter(BaseConverter):
 
     :internal:
     """
+    __slots__ = ('fixed_digits', 'min', 'max')
     weight = 50
 
     def __init__(self, map, fixed_digits=0, min=None, max=None):
@@ -947,6 +1680,7 @@ class IntegerConverter(NumberConverter):
     :param min: the minimal value.
     :param max: the maximal value.
     """
+    __slots__ = ()
     regex = r'\d+'
     num_convert = int
 
@@ -962,6 +1696,7 @@ class FloatConverter(NumberConverter):
     :param min: the minimal value.
     :param max: the maximal value.
     """
+    __slots__ = ()
     regex = r'\d+\.\d+'
     num_convert = float
 
@@ -978,6 +1713,7 @@ class UUIDConverter(BaseConverter):
 
     :param map: the :class:`Map`.
     """
+    __slots__ = ()
     regex = r'[A-Fa-f0-9]{8}-[A-Fa-f0-9]{4}-' \
             r'[A-Fa-f0-9]{4}-[A-Fa-f0-9]{4}-[A-Fa-f0-9]{12}'
 
@@ -1000,82 +1736,859 @@ DEFAULT_CONVERTERS = {
 }
 
 
-class Map(object):
-    """The map class stores all the URL rules and some configuration
-    parameters.  Some of the configuration values are only stored on the
-    `Map` instance since those affect all rules, others are just defaults
-    and can be overridden for each rule.  Note that you have to specify all
-    arguments besides the `rules` as keyword arguments!
+class RuleMatcher(object):
+    """The default matcher of the :class:`Map`.  A matcher picks the rules
+    that have to be tested for a request, :meth:`MapAdapter.match` then
+    tries them one after another with :meth:`Rule.match`.  This one groups
+    the rules by their subdomain (or host if host matching is enabled) and
+    returns the rules of the requested domain plus the rules with
+    converters in their domain part in the order of
+    :meth:`Rule.match_compare_key`.
 
-    :param rules: sequence of url rules for this map.
-    :param default_subdomain: The default subdomain for rules without a
-                              subdomain defined.
-    :param charset: charset of the url. defaults to ``"utf-8"``
-    :param strict_slashes: Take care of trailing slashes.
-    :param redirect_defaults: This will redirect to the default rule if it
-                              wasn't visited that way. This helps creating
-                              unique URLs.
-    :param converters: A dict of converters that adds additional converters
-                       to the list of converters. If you redefine one
-                       converter this will override the original one.
-    :param sort_parameters: If set to `True` the url parameters are sorted.
-                            See `url_encode` for more details.
-    :param sort_key: The sort key function for `url_encode`.
-    :param encoding_errors: the error method to use for decoding
-    :param host_matching: if set to `True` it enables the host matching
-                          feature and disables the subdomain one.  If
-                          enabled the `host` parameter to rules is used
-                          instead of the `subdomain` one.
+    Custom matchers can be passed to the map as `matcher` parameter.  They
+    must never leave out a rule that could match and have to return the
+    candidates in the same order as the map.
 
-    .. versionadded:: 0.5
-        `sort_parameters` and `sort_key` was added.
+    .. versionadded:: 0.10
 
-    .. versionadded:: 0.7
-        `encoding_errors` and `host_matching` was added.
+    :param map: the :class:`Map`.
     """
 
-    #: .. versionadded:: 0.6
-    #:    a dict of default converters to be used.
-    default_converters = ImmutableDict(DEFAULT_CONVERTERS)
+    def __init__(self, map):
+        self.map = map
+        self.rules = []
+        self.static_domains = {}
+        self.dynamic_domains = []
+        self._positions = {}
+        self._domain_rules = {}
+
+    def update(self, rules):
+        """Called by :meth:`Map.update` with the sorted list of rules every
+        time the rules of the map changed.  Rules without arguments are
+        looked up by the map itself and are not passed to the matcher.
+        """
+        self.rules = rules
+        self.static_domains = {}
+        self.dynamic_domains = []
+        self._domain_rules = {}
+        # the positions of the rules are used to merge the rules of a
+        # domain with the rules that have converters in their domain part.
+        self._positions = dict((id(rule), pos) for pos, rule
+                               in enumerate(rules))
+        for rule in rules:
+            key = self._get_bucket_key(rule)
+            if key is None:
+                self.dynamic_domains.append(rule)
+            else:
+                self.static_domains.setdefault(key, []).append(rule)
 
-    def __init__(self, rules=None, default_subdomain='', charset='utf-8',
-                 strict_slashes=True, redirect_defaults=True,
-                 converters=None, sort_parameters=False, sort_key=None,
-                 encoding_errors='replace', host_matching=False):
-        self._rules = []
-        self._rules_by_endpoint = {}
-        self._remap = True
+    def insert(self, rule):
+        """Called by :meth:`Map.update` instead of :meth:`update` for every
+        rule that was added with :meth:`Map.add` since the last update, so
+        that a single new rule does not rebuild the whole matcher.  Matchers
+        that keep more state than this one have to extend it.
+        """
+        rules = list(self.rules)
+        _insort_rule(rules, rule, lambda x: x.match_compare_key())
+        # the positions go first as the buckets may only hold rules that
+        # have one.  Every list is copied and replaced instead of changed
+        # because other threads could be matching meanwhile.
+        self._positions = dict((id(rule), pos) for pos, rule
+                               in enumerate(rules))
+        self.rules = rules
+        key = self._get_bucket_key(rule)
+        if key is None:
+            bucket = list(self.dynamic_domains)
+            _insort_rule(bucket, rule, lambda x: x.match_compare_key())
+            self.dynamic_domains = bucket
+        else:
+            bucket = list(self.static_domains.get(key, ()))
+            _insort_rule(bucket, rule, lambda x: x.match_compare_key())
+            self.static_domains[key] = bucket
+        self._domain_rules = {}
+
+    def reorder(self, rules):
+        """Called by the map if `reorder_interval` is set with the rules of
+        the last update in a new order that does not change which rule
+        matches a URL.  The buckets are only sorted again, which is a lot
+        cheaper than :meth:`update`.  Matchers that keep the rules in an
+        order of their own have to extend it.
+        """
+        positions = dict((id(rule), pos) for pos, rule in enumerate(rules))
+        key = lambda rule: positions[id(rule)]
+        static_domains = dict((domain_key, sorted(bucket, key=key))
+                              for domain_key, bucket
+                              in iteritems(self.static_domains))
+        dynamic_domains = sorted(self.dynamic_domains, key=key)
+        # the orders only differ within runs of rules that can never match
+        # the same URL, so other threads that mix the old and the new state
+        # meanwhile still get the rules of every run in the right order.
+        self._positions = positions
+        self.rules = rules
+        self.static_domains = static_domains
+        self.dynamic_domains = dynamic_domains
+        self._domain_rules = {}
 
-        self.default_subdomain = default_subdomain
-        self.charset = charset
-        self.encoding_errors = encoding_errors
-        self.strict_slashes = strict_slashes
-        self.redirect_defaults = redirect_defaults
-        self.host_matching = host_matching
+    def _get_bucket_key(self, rule):
+        """Returns the static domain part of a rule or `None` if it has
+        converters in its domain part.
 
-        self.converters = self.default_converters.copy()
-        if converters:
-            self.converters.update(converters)
+        :internal:
+        """
+        split = rule._trace.index((False, u'|'))
+        domain_trace = rule._trace[:split]
+        if all(not is_dynamic for is_dynamic, data in domain_trace):
+            return u''.join(data for is_dynamic, data in domain_trace)
+
+    def get_domain_key(self, domain_part):
+        """Returns the key of the bucket for a domain part.  That's the
+        domain part itself if rules exist for it, otherwise `None` which
+        stands for the rules with converters in their domain part.
+        """
+        if domain_part in self.static_domains:
+            return domain_part
 
-        self.sort_parameters = sort_parameters
-        self.sort_key = sort_key
+    def get_rules(self, domain_part):
+        """Returns all rules that could match the given domain part in
+        matching order.
+        """
+        key = self.get_domain_key(domain_part)
+        # a merge that raced with :meth:`insert` ends up in the old dict
+        cache = self._domain_rules
+        rv = cache.get(key)
+        if rv is not None:
+            return rv
+        if key is None:
+            rv = self.dynamic_domains
+        elif not self.dynamic_domains:
+            rv = self.static_domains[key]
+        else:
+            rv = _merge_rules(self.static_domains[key], self.dynamic_domains,
+                              self._positions)
+        cache[key] = rv
+        return rv
+
+    def iter_candidates(self, domain_part, path, stats=None):
+        """Returns an iterable of rules that could match the given domain
+        part (the subdomain or the host if host matching is enabled) and
+        path in matching order.  If instrumentation is enabled on the map
+        a :class:`MatchStats` object is passed as `stats` which matchers
+        running regular expressions should count on.
+        """
+        return self.get_rules(domain_part)
 
-        for rulefactory in rules or ():
-            self.add(rulefactory)
 
-    def is_endpoint_expecting(self, endpoint, *arguments):
-        """Iterate over all rules and check if the endpoint expects
-        the arguments provided.  This is for example useful if you have
-        some URLs that expect a language code and others that do not and
-        you want to wrap the builder a bit so that the current language
-        code is automatically added if not provided but endpoints expect
-        it.
+class _TrieNode(object):
+    """A node of the :class:`TrieMatcher`.
 
-        :param endpoint: the endpoint to check.
-        :param arguments: this function accepts one or more arguments
-                          as positional arguments.  Each one of them is
-                          checked.
-        """
+    :internal:
+    """
+
+    def __init__(self):
+        self.static = {}
+        self.dynamic = []
+        self.dynamic_by_regex = {}
+        self.rules = []
+        self.tail = []
+
+    def get_child(self, segment):
+        if all(not is_dynamic for is_dynamic, data in segment):
+            key = u''.join(data for is_dynamic, data in segment)
+            child = self.static.get(key)
+            if child is None:
+                child = self.static[key] = _TrieNode()
+            return child
+        regex = u''.join(is_dynamic and u'(?:%s)' % data or re.escape(data)
+                         for is_dynamic, data in segment)
+        child = self.dynamic_by_regex.get(regex)
+        if child is None:
+            child = self.dynamic_by_regex[regex] = _TrieNode()
+            self.dynamic.append((re.compile(u'(?:%s)\\Z' % regex,
+                                            re.UNICODE), child))
+        return child
+
+
+class TrieMatcher(RuleMatcher):
+    """A matcher that sorts the rules into a trie of path segments.  Static
+    segments are looked up in a dictionary, segments with converters are
+    tested with the regular expression of just that segment.  Only the rules
+    found this way are tested by the adapter, so the costs of matching
+    depend on the depth of the path and not on the number of rules::
+
+        url_map = Map([...], matcher=TrieMatcher)
+
+    Rules with converters that can match a slash (see
+    :attr:`BaseConverter.part_isolating`) are tested for every path that
+    reaches the segment the converter starts in.
+
+    .. versionadded:: 0.10
+    """
+
+    def update(self, rules):
+        RuleMatcher.update(self, rules)
+        self.static_nodes = {}
+        self.dynamic_nodes = []
+        self._dynamic_nodes_by_regex = {}
+        for rule in rules:
+            self._add_to_trie(rule)
+
+    def insert(self, rule):
+        RuleMatcher.insert(self, rule)
+        self._add_to_trie(rule)
+
+    def _add_to_trie(self, rule):
+        """Adds a rule to the node of the trie its path leads to.  The
+        nodes are only ever extended, so matching can go on meanwhile.
+
+        :internal:
+        """
+        split = rule._trace.index((False, u'|'))
+        domain_trace = rule._trace[:split]
+        path_trace = rule._trace[split + 1:]
+        if not rule.is_leaf:
+            path_trace = path_trace[:-1]
+
+        if all(not is_dynamic for is_dynamic, data in domain_trace):
+            key = u''.join(data for is_dynamic, data in domain_trace)
+            node = self.static_nodes.get(key)
+            if node is None:
+                node = self.static_nodes[key] = _TrieNode()
+        else:
+            regex = u''.join(
+                is_dynamic and u'(?:%s)' % rule._converters[data].regex or
+                re.escape(data) for is_dynamic, data in domain_trace)
+            node = self._dynamic_nodes_by_regex.get(regex)
+            if node is None:
+                node = self._dynamic_nodes_by_regex[regex] = _TrieNode()
+                self.dynamic_nodes.append((re.compile(
+                    u'(?:%s)\\Z' % regex, re.UNICODE), node))
+
+        segments = [[]]
+        is_tail = False
+        for is_dynamic, data in path_trace:
+            if is_dynamic:
+                converter = rule._converters[data]
+                if not converter.part_isolating:
+                    is_tail = True
+                    break
+                segments[-1].append((True, converter.regex))
+            else:
+                pieces = data.split(u'/')
+                if pieces[0]:
+                    segments[-1].append((False, pieces[0]))
+                for piece in pieces[1:]:
+                    segments.append([(False, piece)])
+
+        # the path always starts with a slash so the first segment is
+        # empty.  In case the rule ends in a converter that can match
+        # slashes the last segment is incomplete and checked by the
+        # regular expression of the rule only.
+        segments = segments[1:]
+        if is_tail:
+            segments.pop()
+        for segment in segments:
+            node = node.get_child(segment)
+        if is_tail:
+            node.tail.append(rule)
+        else:
+            node.rules.append(rule)
+
+    def iter_candidates(self, domain_part, path, stats=None):
+        # the regular expressions of the rules end with a dollar sign which
+        # also matches before a trailing newline.  Such paths are rare enough
+        # to just try all rules.
+        if u'\n' in path or u'|' in domain_part:
+            return self.get_rules(domain_part)
+
+        stack = []
+        node = self.static_nodes.get(domain_part)
+        if node is not None:
+            stack.append((node, 0))
+        for regex, node in self.dynamic_nodes:
+            if regex.match(domain_part) is not None:
+                stack.append((node, 0))
+        if stats is not None:
+            stats.regex_searches += len(self.dynamic_nodes)
+
+        segments = path[1:].split(u'/')
+        end = len(segments)
+        found = []
+        while stack:
+            node, idx = stack.pop()
+            found.extend(node.tail)
+            # a trailing slash is handled by the rules themselves
+            if idx == end or (idx == end - 1 and not segments[idx]):
+                found.extend(node.rules)
+            if idx < end:
+                segment = segments[idx]
+                child = node.static.get(segment)
+                if child is not None:
+                    stack.append((child, idx + 1))
+                for regex, child in node.dynamic:
+                    if regex.match(segment) is not None:
+                        stack.append((child, idx + 1))
+                if stats is not None:
+                    stats.regex_searches += len(node.dynamic)
+
+        # looked up after the trie as :meth:`insert` publishes the positions
+        # before it adds a rule to a node.
+        positions = self._positions
+        found.sort(key=lambda rule: positions[id(rule)])
+        return found
+
+
+class RegexMatcher(RuleMatcher):
+    """A matcher that combines the rules of a subdomain (or host if host
+    matching is enabled) into one big regular expression.  A single match
+    of that expression finds the first rule that matches the URL, so the
+    rules before it never have to be tried::
+
+        url_map = Map([...], matcher=RegexMatcher)
+
+    Rules with converters that use groups in their regular expression or
+    that can match slashes are tried one by one, this keeps path converters
+    out of the combined expression.
+
+    .. versionadded:: 0.10
+    """
+
+    #: the maximum number of rules combined into one regular expression
+    #: or `None` for no limit.  Python versions before 3.5 do not support
+    #: more than 100 groups, so the limit is only set for them.
+    max_rules_per_regex = sys.version_info < (3, 5) and 90 or None
+
+    def update(self, rules):
+        RuleMatcher.update(self, rules)
+        # the chunks of every domain part are compiled right away so that
+        # the first request for a domain part doesn't have to wait for it.
+        compiled = {}
+        for key in list(self.static_domains) + [None]:
+            compiled[key] = self._compile_rules(self.get_rules(key))
+        self._compiled = compiled
+
+    def reorder(self, rules):
+        # a combined expression finds the first rule that matches in one
+        # search whatever the order of its rules, so the chunks are kept.
+        RuleMatcher.reorder(self, rules)
+
+    def insert(self, rule):
+        RuleMatcher.insert(self, rule)
+        key = self._get_bucket_key(rule)
+        compiled = {}
+        for domain_key, chunks in iteritems(self._compiled):
+            if key is None or key == domain_key:
+                chunks = self._insert_into_chunks(chunks, rule)
+            compiled[domain_key] = chunks
+        if key is not None and key not in compiled:
+            compiled[key] = self._compile_rules(self.get_rules(key))
+        self._compiled = compiled
+
+    def _insert_into_chunks(self, chunks, rule):
+        """Returns a copy of the chunks of a domain part (see
+        :meth:`compile_domain`) with a new rule inserted.  Only the chunk
+        the rule goes into is compiled again.
+
+        :internal:
+        """
+        positions = self._positions
+        pos = positions[id(rule)]
+        # the first chunk with a rule that comes after the new one
+        idx = 0
+        while idx < len(chunks) and positions[id(chunks[idx][1][-1])] < pos:
+            idx += 1
+        source = self._get_combinable_source(rule)
+        if source is not None:
+            if idx < len(chunks) and chunks[idx][0] is not None:
+                target = idx
+            elif idx > 0 and chunks[idx - 1][0] is not None:
+                target = idx - 1
+            else:
+                return chunks[:idx] + self._combine([(rule, source)]) + \
+                    chunks[idx:]
+            items = [(r, r._get_regex_source(capture=False))
+                     for r in chunks[target][1]]
+            _insort_rule(items, (rule, source),
+                         lambda item: positions[id(item[0])])
+            return chunks[:target] + self._combine(items) + \
+                chunks[target + 1:]
+
+        # a rule that cannot be combined splits the chunk it falls into
+        if idx < len(chunks) and chunks[idx][0] is not None and \
+           positions[id(chunks[idx][1][0])] < pos:
+            items = [(r, r._get_regex_source(capture=False))
+                     for r in chunks[idx][1]]
+            split = 0
+            while positions[id(items[split][0])] < pos:
+                split += 1
+            return chunks[:idx] + self._combine(items[:split]) + \
+                [(None, [rule])] + self._combine(items[split:]) + \
+                chunks[idx + 1:]
+        return chunks[:idx] + [(None, [rule])] + chunks[idx:]
+
+    def _get_combinable_source(self, rule):
+        """Returns the regular expression of a rule without the capturing
+        groups or `None` if the rule cannot be combined with others.
+
+        :internal:
+        """
+        if any(not converter.part_isolating
+               for converter in itervalues(rule._converters)):
+            return None
+        source = rule._get_regex_source(capture=False)
+        try:
+            if re.compile(source, re.UNICODE).groups == 0:
+                return source
+        except re.error:
+            pass
+
+    def _combine(self, items):
+        """Compiles a list of ``(rule, source)`` items into chunks of at
+        most :attr:`max_rules_per_regex` rules.
+
+        :internal:
+        """
+        rv = []
+        size = self.max_rules_per_regex or len(items) or 1
+        for start in range(0, len(items), size):
+            part = items[start:start + size]
+            # the groups that tell the rules apart are empty and come last.
+            # The regex engine clears the groups before one when it enters
+            # it, so a group in front would do that for every rule tried.
+            regex = u'|'.join(u'%s(?P<_%d>)$' % (source, idx)
+                              for idx, (rule, source) in enumerate(part))
+            rv.append((re.compile(regex, re.UNICODE),
+                       [rule for rule, source in part]))
+        return rv
+
+    def compile_domain(self, domain_part):
+        """Returns the rules for a domain part as a list of chunks in the
+        form ``(regex, rules)``.  If `regex` is `None` the rules have to be
+        tried one after another.  The chunks are compiled by :meth:`update`.
+        """
+        key = self.get_domain_key(domain_part)
+        cache = self._compiled
+        rv = cache.get(key)
+        if rv is None:
+            rv = cache[key] = self._compile_rules(self.get_rules(key))
+        return rv
+
+    def _compile_rules(self, rules):
+        """Compiles a list of rules in matching order into chunks (see
+        :meth:`compile_domain`).
+
+        :internal:
+        """
+        rv = []
+        pending = []
+        for rule in rules:
+            source = self._get_combinable_source(rule)
+            if source is None:
+                rv.extend(self._combine(pending))
+                pending = []
+                rv.append((None, [rule]))
+            else:
+                pending.append((rule, source))
+        rv.extend(self._combine(pending))
+        return rv
+
+    def iter_candidates(self, domain_part, path, stats=None):
+        path = u'%s|%s' % (domain_part, path)
+        for regex, rules in self.compile_domain(domain_part):
+            if regex is None:
+                for rule in rules:
+                    yield rule
+                continue
+            if stats is not None:
+                stats.regex_searches += 1
+            m = regex.match(path)
+            if m is None:
+                continue
+            # if the winning rule is not taken (because of the method or
+            # a failing converter) the rules after it are tried one by one
+            for rule in rules[int(m.lastgroup[1:]):]:
+                yield rule
+
+
+class _MatchCache(object):
+    """A thread safe LRU cache for the outcomes of :meth:`Map._match`.
+
+    :internal:
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = self.misses = self.evictions = 0
+        self._lock = Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._data = {}
+            # the entries are kept in a circular doubly linked list of
+            # ``[prev, next, key, value]`` lists, most recently used last.
+            self._root = root = []
+            root[:] = [root, root, None, None]
+
+    def get(self, key):
+        with self._lock:
+            link = self._data.get(key)
+            if link is None:
+                self.misses += 1
+                return None
+            prev, next, key, value = link
+            prev[1] = next
+            next[0] = prev
+            root = self._root
+            last = root[0]
+            last[1] = root[0] = link
+            link[0] = last
+            link[1] = root
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            if key in self._data:
+                return
+            root = self._root
+            last = root[0]
+            last[1] = root[0] = self._data[key] = [last, root, key, value]
+            if len(self._data) > self.maxsize:
+                oldest = root[1]
+                root[1] = oldest[1]
+                oldest[1][0] = root
+                del self._data[oldest[2]]
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getstate__(self):
+        # the entries are dropped, the linked list would be pickled
+        # recursively and the map clears the cache after unpickling anyway.
+        return dict((key, value) for key, value in iteritems(self.__dict__)
+                    if key not in ('_lock', '_data', '_root'))
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = Lock()
+        self.clear()
+
+
+class MatchStats(object):
+    """Collects what happened while a URL was matched.  If instrumentation
+    is enabled on a :class:`Map` an instance is passed to the callback
+    after every match.
+
+    .. versionadded:: 0.10
+
+    .. attribute:: domain_part
+
+       the subdomain, or the host if host matching is enabled.
+
+    .. attribute:: path_info
+
+       the path that was matched.
+
+    .. attribute:: method
+
+       the HTTP method that was matched.
+
+    .. attribute:: kind
+
+       the outcome: ``'match'``, ``'slash'`` or ``'redirect'`` for missing
+       trailing slashes and default redirects, ``'alias'``,
+       ``'method_not_allowed'`` or ``'not_found'``.
+
+    .. attribute:: rule
+
+       the rule that matched or caused a redirect, otherwise `None`.
+
+    .. attribute:: cached
+
+       `True` if the outcome came from the match cache.  No rules were
+       tried in that case.
+
+    .. attribute:: rules_tried
+
+       the number of rules whose regular expression was tried.
+
+    .. attribute:: regex_searches
+
+       the number of regular expression searches, including the ones of
+       the matcher.
+
+    .. attribute:: converter_time
+
+       the seconds spent converting values to Python.
+
+    .. attribute:: default_redirect_time
+
+       the seconds spent looking for rules providing defaults for the
+       matched rule.
+
+    .. attribute:: total_time
+
+       the seconds the match took.
+    """
+    __slots__ = ('domain_part', 'path_info', 'method', 'kind', 'rule',
+                 'cached', 'rules_tried', 'regex_searches', 'converter_time',
+                 'default_redirect_time', 'total_time')
+    __getstate__ = _get_slots_state
+    __setstate__ = _set_slots_state
+
+    def __init__(self, domain_part, path_info, method):
+        self.domain_part = domain_part
+        self.path_info = path_info
+        self.method = method
+        self.kind = None
+        self.rule = None
+        self.cached = False
+        self.rules_tried = 0
+        self.regex_searches = 0
+        self.converter_time = 0.0
+        self.default_redirect_time = 0.0
+        self.total_time = 0.0
+
+    def __repr__(self):
+        return '<%s %s|%s (%s) %s, %d rules tried>' % (
+            self.__class__.__name__,
+            self.domain_part,
+            self.path_info,
+            self.method,
+            self.kind,
+            self.rules_tried
+        )
+
+
+class MatchStatsCollector(object):
+    """An instrumentation callback for :class:`Map` that sums up the
+    :class:`MatchStats` of all matches and counts the hits of every rule::
+
+        collector = MatchStatsCollector()
+        url_map = Map([...], instrumentation=collector)
+        ...
+        for rule, hits in collector.iter_rule_hits():
+            log.info('%s: %d hits', rule, hits)
+
+    .. versionadded:: 0.10
+
+    :param slow_threshold: matches taking at least that many seconds are
+                           remembered in :attr:`slow_matches`.
+    :param max_slow_matches: the number of slow matches to remember.
+    """
+
+    def __init__(self, slow_threshold=None, max_slow_matches=100):
+        self.slow_threshold = slow_threshold
+        self.max_slow_matches = max_slow_matches
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """Forgets everything that was collected."""
+        #: the number of matches by outcome.
+        self.kinds = {}
+        #: the sums over all matches.
+        self.matches = self.rules_tried = self.regex_searches = 0
+        self.converter_time = self.default_redirect_time = \
+            self.total_time = 0.0
+        #: the :class:`MatchStats` of the slowest matches, slowest first.
+        self.slow_matches = []
+        self._rule_hits = {}
+
+    def __call__(self, stats):
+        self._lock.acquire()
+        try:
+            self.kinds[stats.kind] = self.kinds.get(stats.kind, 0) + 1
+            self.matches += 1
+            self.rules_tried += stats.rules_tried
+            self.regex_searches += stats.regex_searches
+            self.converter_time += stats.converter_time
+            self.default_redirect_time += stats.default_redirect_time
+            self.total_time += stats.total_time
+            if stats.rule is not None:
+                # rules are not hashable, count them by identity
+                item = self._rule_hits.get(id(stats.rule))
+                if item is None:
+                    item = self._rule_hits[id(stats.rule)] = [stats.rule, 0]
+                item[1] += 1
+            if self.slow_threshold is not None and \
+               stats.total_time >= self.slow_threshold:
+                slow = self.slow_matches
+                slow.append(stats)
+                slow.sort(key=lambda x: -x.total_time)
+                del slow[self.max_slow_matches:]
+        finally:
+            self._lock.release()
+
+    def iter_rule_hits(self):
+        """Iterates over ``(rule, hits)`` tuples for the rules that were
+        hit, the most frequently hit rules first.
+        """
+        self._lock.acquire()
+        try:
+            items = [tuple(item) for item in itervalues(self._rule_hits)]
+        finally:
+            self._lock.release()
+        items.sort(key=lambda x: -x[1])
+        return iter(items)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = Lock()
+        # the hits are keyed by the ids of the rules, the copies have
+        # other ones.
+        self._rule_hits = dict((id(item[0]), item)
+                               for item in itervalues(self._rule_hits))
+
+
+class Map(object):
+    """The map class stores all the URL rules and some configuration
+    parameters.  Some of the configuration values are only stored on the
+    `Map` instance since those affect all rules, others are just defaults
+    and can be overridden for each rule.  Note that you have to specify all
+    arguments besides the `rules` as keyword arguments!
+
+    :param rules: sequence of url rules for this map.
+    :param default_subdomain: The default subdomain for rules without a
+                              subdomain defined.
+    :param charset: charset of the url. defaults to ``"utf-8"``
+    :param strict_slashes: Take care of trailing slashes.
+    :param redirect_defaults: This will redirect to the default rule if it
+                              wasn't visited that way. This helps creating
+                              unique URLs.
+    :param converters: A dict of converters that adds additional converters
+                       to the list of converters. If you redefine one
+                       converter this will override the original one.
+    :param sort_parameters: If set to `True` the url parameters are sorted.
+                            See `url_encode` for more details.
+    :param sort_key: The sort key function for `url_encode`.
+    :param encoding_errors: the error method to use for decoding
+    :param host_matching: if set to `True` it enables the host matching
+                          feature and disables the subdomain one.  If
+                          enabled the `host` parameter to rules is used
+                          instead of the `subdomain` one.  Rules with a
+                          static host are looked up by the host, so only
+                          the rules of that host and the rules with
+                          converters in their host are tried.
+    :param matcher: the matcher class that picks the rules to test when
+                    matching.  Defaults to :attr:`default_matcher`.
+    :param lazy_compile: if set to `True` the regular expressions of the
+                         rules are compiled when they are needed for the
+                         first time instead of when they are added.  This
+                         speeds up the creation of big maps where most of
+                         the rules are rarely used.
+    :param match_cache_size: if set to a number, the outcomes of that many
+                             matches are remembered by subdomain (or host),
+                             path and method.  The cache is cleared when
+                             rules are added or refreshed.  Matches with
+                             converted values that could be changed (like
+                             lists or custom objects) are not cached, so
+                             every request gets values of its own.
+    :param reorder_interval: if set to a number, the map counts how often
+                             rules with converters match and reorders them
+                             by their hits every that many matches.  Only
+                             rules that can never match the same URL
+                             trade places, so this does not change which
+                             rule matches.  The counts are halved every
+                             time so that the order follows the traffic.
+    :param instrumentation: a function that is called with a
+                            :class:`MatchStats` object after every match,
+                            for example a :class:`MatchStatsCollector`.
+                            If it's `None` (the default) no statistics are
+                            collected.
+
+    Maps can be pickled if their endpoints, defaults and converters can
+    be pickled.  Parsed rules are stored, compiled regular expressions are
+    not.  A loaded map compiles the regular expression of a rule when
+    that rule is first used, the same as with `lazy_compile`.  So loading
+    a big map from a pickle is faster than creating it from its rules
+    again.
+
+    .. versionadded:: 0.5
+        `sort_parameters` and `sort_key` was added.
+
+    .. versionadded:: 0.7
+        `encoding_errors` and `host_matching` was added.
+
+    .. versionadded:: 0.10
+        `matcher`, `lazy_compile`, `match_cache_size`, `reorder_interval`
+        and `instrumentation` were added.
+    """
+
+    #: .. versionadded:: 0.6
+    #:    a dict of default converters to be used.
+    default_converters = ImmutableDict(DEFAULT_CONVERTERS)
+
+    #: .. versionadded:: 0.10
+    #:    the matcher class used if no `matcher` is passed.
+    default_matcher = RuleMatcher
+
+    def __init__(self, rules=None, default_subdomain='', charset='utf-8',
+                 strict_slashes=True, redirect_defaults=True,
+                 converters=None, sort_parameters=False, sort_key=None,
+                 encoding_errors='replace', host_matching=False,
+                 matcher=None, lazy_compile=False, match_cache_size=None,
+                 reorder_interval=None, instrumentation=None):
+        self._rules = []
+        self._rules_by_endpoint = {}
+        self._static_rules = {}
+        self._first_segments = {None: (frozenset(), ())}
+        self._default_redirects = {}
+        self._build_candidates = {}
+        self._converter_instances = {}
+        self._match_groups = {}
+        self._remap = True
+        self._resort = False
+        self._added = None
+        self._update_lock = Lock()
+        self._matcher = (matcher or self.default_matcher)(self)
+        self._match_cache = None
+        if match_cache_size:
+            self._match_cache = _MatchCache(match_cache_size)
+        self._disjoint_runs = []
+        self._rule_hits = {}
+        self._hits_since_reorder = 0
+        self._reorder_lock = Lock()
+
+        self.default_subdomain = default_subdomain
+        self.charset = charset
+        self.encoding_errors = encoding_errors
+        self.strict_slashes = strict_slashes
+        self.redirect_defaults = redirect_defaults
+        self.host_matching = host_matching
+        self.lazy_compile = lazy_compile
+        self.reorder_interval = reorder_interval
+        self.instrumentation = instrumentation
+
+        self.converters = self.default_converters.copy()
+        if converters:
+            self.converters.update(converters)
+
+        self.sort_parameters = sort_parameters
+        self.sort_key = sort_key
+
+        if rules:
+            self.add_many(rules)
+
+    def is_endpoint_expecting(self, endpoint, *arguments):
+        """Iterate over all rules and check if the endpoint expects
+        the arguments provided.  This is for example useful if you have
+        some URLs that expect a language code and others that do not and
+        you want to wrap the builder a bit so that the current language
+        code is automatically added if not provided but endpoints expect
+        it.
+
+        :param endpoint: the endpoint to check.
+        :param arguments: this function accepts one or more arguments
+                          as positional arguments.  Each one of them is
+                          checked.
+        """
         self.update()
         arguments = set(arguments)
         for rule in self._rules_by_endpoint[endpoint]:
@@ -1103,10 +2616,70 @@ class Map(object):
         """
         for rule in rulefactory.get_rules(self):
             rule.bind(self)
-            self._rules.append(rule)
-            self._rules_by_endpoint.setdefault(rule.endpoint, []).append(rule)
+            endpoint_rules = self._rules_by_endpoint.setdefault(
+                rule.endpoint, [])
+            # until the first update the rules are sorted only once, by
+            # :meth:`update`, which computes the sort keys once per rule.
+            if self._resort or self._added is None:
+                self._rules.append(rule)
+                endpoint_rules.append(rule)
+                self._resort = True
+            else:
+                _insort_rule(self._rules, rule,
+                             lambda x: x.match_compare_key())
+                _insort_rule(endpoint_rules, rule,
+                             lambda x: x.build_compare_key())
+                if self._added is not None:
+                    self._added.append(rule)
         self._remap = True
 
+    def add_many(self, rulefactories):
+        """Like :meth:`add` but for a sequence of rules or factories.  The
+        rules are sorted only once which is faster than adding a lot of
+        rules one after another.  Every rule factory is passed to
+        :meth:`add`.
+
+        .. versionadded:: 0.10
+
+        :param rulefactories: an iterable of :class:`Rule` or
+                              :class:`RuleFactory` objects.
+        """
+        self._resort = True
+        for rulefactory in rulefactories:
+            self.add(rulefactory)
+
+    def _get_converter(self, converter_class, args, kwargs):
+        """Returns an instance of the converter class for the arguments.
+        Converters are interned so that rules with the same converter share
+        one instance.
+
+        :internal:
+        """
+        try:
+            key = (converter_class, tuple(args),
+                   tuple(sorted(iteritems(kwargs))))
+            rv = self._converter_instances.get(key)
+        except TypeError:
+            # unhashable arguments, don't intern those
+            return converter_class(self, *args, **kwargs)
+        if rv is None:
+            rv = self._converter_instances[key] = \
+                converter_class(self, *args, **kwargs)
+        return rv
+
+    def _get_match_groups(self, match_groups):
+        """Returns an interned copy of the group positions of a rule (see
+        :meth:`Rule._compile_regex`).  As converters are shared, a lot of
+        rules have the same group positions and can share one tuple.
+
+        :internal:
+        """
+        try:
+            return self._match_groups.setdefault(match_groups, match_groups)
+        except TypeError:
+            # a converter that cannot be hashed
+            return match_groups
+
     def bind(self, server_name, script_name=None, subdomain=None,
              url_scheme='http', default_method='GET', path_info=None,
              query_args=None):
@@ -1181,35 +2754,9 @@ class Map(object):
         """
         environ = _get_environ(environ)
         if server_name is None:
-            if 'HTTP_HOST' in environ:
-                server_name = environ['HTTP_HOST']
-            else:
-                server_name = environ['SERVER_NAME']
-                if (environ['wsgi.url_scheme'], environ['SERVER_PORT']) not \
-                   in (('https', '443'), ('http', '80')):
-                    server_name += ':' + environ['SERVER_PORT']
+            server_name = _get_server_name(environ)
         elif subdomain is None and not self.host_matching:
-            server_name = server_name.lower()
-            if 'HTTP_HOST' in environ:
-                wsgi_server_name = environ.get('HTTP_HOST')
-            else:
-                wsgi_server_name = environ.get('SERVER_NAME')
-                if (environ['wsgi.url_scheme'], environ['SERVER_PORT']) not \
-                   in (('https', '443'), ('http', '80')):
-                    wsgi_server_name += ':' + environ['SERVER_PORT']
-            wsgi_server_name = wsgi_server_name.lower()
-            cur_server_name = wsgi_server_name.split('.')
-            real_server_name = server_name.split('.')
-            offset = -len(real_server_name)
-            if cur_server_name[offset:] != real_server_name:
-                # This can happen even with valid configs if the server was
-                # accesssed directly by IP address under some situations.
-                # Instead of raising an exception like in Werkzeug 0.7 or
-                # earlier we go by an invalid subdomain which will result
-                # in a 404 error on matching.
-                subdomain = '<invalid>'
-            else:
-                subdomain = '.'.join(filter(None, cur_server_name[:offset]))
+            subdomain = self._get_subdomain(environ, server_name)
 
         def _get_wsgi_string(name):
             val = environ.get(name)
@@ -1224,25 +2771,685 @@ class Map(object):
                         environ['REQUEST_METHOD'], path_info,
                         query_args=query_args)
 
+    def _get_subdomain(self, environ, server_name):
+        """Calculates the current subdomain from the host in the environ and
+        the server name without the subdomain.
+
+        :internal:
+        """
+        cur_server_name = _get_server_name(environ).lower().split('.')
+        real_server_name = server_name.lower().split('.')
+        offset = -len(real_server_name)
+        if cur_server_name[offset:] != real_server_name:
+            # This can happen even with valid configs if the server was
+            # accesssed directly by IP address under some situations.
+            # Instead of raising an exception like in Werkzeug 0.7 or
+            # earlier we go by an invalid subdomain which will result
+            # in a 404 error on matching.
+            return '<invalid>'
+        return '.'.join(filter(None, cur_server_name[:offset]))
+
+    def match_environ(self, environ, server_name=None, subdomain=None,
+                      return_rule=False):
+        """Matches the URL of a WSGI environment.  This works like binding
+        the map with :meth:`bind_to_environ` and calling
+        :meth:`MapAdapter.match` on the adapter, but it only does the work
+        needed for matching.  The adapter is only created if the URL has to
+        be redirected::
+
+            def application(environ, start_response):
+                try:
+                    endpoint, args = url_map.match_environ(environ)
+                except HTTPException as e:
+                    return e(environ, start_response)
+                ...
+
+        .. versionadded:: 0.10
+
+        :param environ: a WSGI environment.
+        :param server_name: an optional server name hint (see
+                            :meth:`bind_to_environ`).
+        :param subdomain: optionally the current subdomain (see
+                          :meth:`bind_to_environ`).
+        :param return_rule: return the rule that matched instead of just the
+                            endpoint.
+        """
+        environ = _get_environ(environ)
+        if self.host_matching:
+            if subdomain is not None:
+                raise RuntimeError('host matching enabled and a '
+                                   'subdomain was provided')
+            if server_name is None:
+                server_name = _get_server_name(environ)
+            domain_part = to_unicode(_encode_idna(server_name.lower()))
+        else:
+            if subdomain is None:
+                if server_name is None:
+                    subdomain = self.default_subdomain
+                else:
+                    subdomain = self._get_subdomain(environ, server_name)
+            domain_part = to_unicode(subdomain)
+        domain_part = u'%s' % domain_part
+
+        path_info = to_unicode(wsgi_decoding_dance(
+            environ.get('PATH_INFO', ''), self.charset))
+        method = to_unicode(environ['REQUEST_METHOD']).upper()
+        kind, rule, rv = self._match(domain_part, path_info, method)
+        if kind == 'match' and rule.redirect_to is None:
+            if return_rule:
+                return rule, rv
+            return rule.endpoint, rv
+        if kind == 'method_not_allowed':
+            raise MethodNotAllowed(valid_methods=list(rv))
+        if kind == 'not_found':
+            raise NotFound()
+        adapter = self.bind_to_environ(environ, server_name, subdomain)
+        return adapter._finish_match(adapter._make_result(
+            kind, rule, rv, path_info, method, None), return_rule)
+
     def update(self):
         """Called before matching and building to keep the compiled rules
         in the correct order after things changed.
         """
-        if self._remap:
-            self._rules.sort(key=lambda x: x.match_compare_key())
-            for rules in itervalues(self._rules_by_endpoint):
-                rules.sort(key=lambda x: x.build_compare_key())
+        if not self._remap:
+            return
+        # one thread updates, the others wait for it instead of inserting
+        # the added rules a second time.
+        with self._update_lock:
+            if not self._remap:
+                return
+            if self._added is not None and not self._resort and \
+               not self.reorder_interval and \
+               hasattr(self._matcher, 'insert'):
+                # rules added with :meth:`add` after the first update only
+                # have to be inserted into the indexes and the matcher.
+                added = self._added
+                self._added = []
+                for rule in added:
+                    self._insert_rule(rule)
+            else:
+                self._rebuild()
+                self._added = []
+            self._build_candidates = {}
+            if self._match_cache is not None:
+                self._match_cache.clear()
             self._remap = False
 
+    def _rebuild(self):
+        """Sorts the rules if necessary and builds the indexes and the
+        matcher from scratch.
+
+        :internal:
+        """
+        # rules added with :meth:`add` are inserted at the right place
+        # already, only bulk additions and refreshed rules need sorting
+        # the sorted lists replace the old ones because a list that is
+        # sorted in place looks empty to other threads meanwhile.
+        if self._resort:
+            self._rules = sorted(self._rules,
+                                 key=lambda x: x.match_compare_key())
+            by_endpoint = self._rules_by_endpoint
+            for endpoint, rules in list(iteritems(by_endpoint)):
+                if len(rules) > 1:
+                    by_endpoint[endpoint] = sorted(
+                        rules, key=lambda x: x.build_compare_key())
+            self._resort = False
+
+        # rules without arguments come first and can only match one
+        # path (with or without a trailing slash), so they are indexed
+        # by domain part and path instead of going to the matcher.
+        static_rules = {}
+        dynamic_rules = []
+        for rule in self._rules:
+            if rule.build_only:
+                continue
+            if rule.arguments:
+                dynamic_rules.append(rule)
+                continue
+            static_rules.setdefault(self._get_static_key(rule),
+                                    []).append(rule)
+        self._static_rules = static_rules
+        self._first_segments = self._get_first_segments(dynamic_rules)
+        self._default_redirects = self._get_default_redirects()
+        if self.reorder_interval:
+            self._disjoint_runs = _split_disjoint_runs(dynamic_rules)
+            dynamic_rules = self._order_by_hits()
+        self._replace_matcher(dynamic_rules)
+
+    def _insert_rule(self, rule):
+        """Inserts a rule added with :meth:`add` into the indexes and the
+        matcher.  Like :meth:`_rebuild` this replaces what it changes, so
+        other threads can go on matching with the old state meanwhile.
+
+        :internal:
+        """
+        redirects = dict(self._default_redirects)
+        rules = self._rules_by_endpoint[rule.endpoint]
+        for r in rules:
+            redirects.pop(id(r), None)
+        self._add_default_redirects(redirects, rules)
+        self._default_redirects = redirects
+        if rule.build_only:
+            return
+
+        if not rule.arguments:
+            key = self._get_static_key(rule)
+            rules = list(self._static_rules.get(key, ()))
+            _insort_rule(rules, rule, lambda x: x.match_compare_key())
+            self._static_rules[key] = rules
+            return
+
+        # the rule goes into the matcher first, the entries of the first
+        # segment index could send requests to it already.
+        self._matcher.insert(rule)
+        first_segments = self._first_segments
+        key, segment = self._get_first_segment(rule)
+        if key is None:
+            keys = list(first_segments)
+        else:
+            keys = [key]
+            if key not in first_segments:
+                first_segments[key] = first_segments[None]
+        for key in keys:
+            segments, rules = first_segments[key]
+            if segment is None:
+                rules = list(rules)
+                _insort_rule(rules, rule, lambda x: x.match_compare_key())
+            else:
+                segments = set(segments)
+                segments.add(segment)
+            first_segments[key] = (segments, rules)
+
+    def _get_static_key(self, rule):
+        """Returns the domain part and the path a rule without arguments
+        matches as tuple.
+
+        :internal:
+        """
+        trace = rule._trace
+        if not rule.is_leaf:
+            trace = trace[:-1]
+        return tuple(u''.join(data for is_dynamic, data in trace)
+                     .split(u'|', 1))
+
+    def _get_first_segment(self, rule):
+        """Returns the key of a rule in the first segment index (see
+        :meth:`_get_first_segments`) and its static first path segment,
+        or `None` as segment if the rule has a converter in there.
+
+        :internal:
+        """
+        split = rule._trace.index((False, u'|'))
+        key = u''
+        for is_dynamic, data in rule._trace[:split]:
+            if is_dynamic:
+                key = None
+                break
+            key += data
+
+        literal = u''
+        for is_dynamic, data in rule._trace[split + 1:]:
+            if is_dynamic:
+                break
+            literal += data
+        segment, has_slash = literal[1:], False
+        if u'/' in segment:
+            segment, has_slash = segment.split(u'/', 1)[0], True
+        if is_dynamic and not has_slash:
+            return key, None
+        return key, segment
+
+    def _get_first_segments(self, rules):
+        """Returns a dict that maps the static domain parts of the rules
+        (or `None` for rules with converters in their domain part) to a
+        tuple in the form ``(segments, rules)``.  `segments` is the set of
+        the static first path segments of the rules that can match that
+        domain part, `rules` are the rules with a converter in their first
+        segment in matching order.  Rules with converters in their domain
+        part are part of every entry as they can match every domain.
+
+        :internal:
+        """
+        segments_by_key = {}
+        rules_by_key = {}
+        for idx, rule in enumerate(rules):
+            key, segment = self._get_first_segment(rule)
+            if key not in segments_by_key:
+                segments_by_key[key] = set()
+                rules_by_key[key] = []
+            if segment is None:
+                rules_by_key[key].append((idx, rule))
+            else:
+                segments_by_key[key].add(segment)
+
+        dynamic_segments = segments_by_key.pop(None, set())
+        dynamic_rules = rules_by_key.pop(None, [])
+        rv = {None: (dynamic_segments, [rule for idx, rule in dynamic_rules])}
+        for key, segments in iteritems(segments_by_key):
+            # the indexes keep the rules in matching order
+            rv[key] = (segments | dynamic_segments,
+                       [rule for idx, rule in
+                        sorted(rules_by_key[key] + dynamic_rules,
+                               key=itemgetter(0))])
+        return rv
+
+    def _get_default_redirects(self):
+        """Returns a dict that maps the ids of rules to a tuple in the form
+        ``(providers, count)``.  The first `count` rules of the `providers`
+        list are the rules that come before the rule and can provide
+        defaults for it (see :meth:`Rule.provides_defaults_for`), apart
+        from rules equal to it.  Rules of an endpoint with the same
+        arguments share the list, so this stays small if many hosts have
+        the same endpoints.  Rules without providers are left out.
+
+        :internal:
+        """
+        rv = {}
+        for rules in itervalues(self._rules_by_endpoint):
+            self._add_default_redirects(rv, rules)
+        return rv
+
+    def _add_default_redirects(self, redirects, rules):
+        """Adds the items for the rules of one endpoint to the dict
+        returned by :meth:`_get_default_redirects`.
+
+        :internal:
+        """
+        groups = {}
+        for rule in rules:
+            key = frozenset(rule.arguments)
+            providers = groups.get(key)
+            if providers:
+                redirects[id(rule)] = (providers, len(providers))
+            if rule.defaults and not rule.build_only:
+                groups.setdefault(key, []).append(rule)
+
+    def match_cache_info(self):
+        """Returns a dict with the statistics of the match cache with the
+        keys ``'hits'``, ``'misses'``, ``'evictions'``, ``'size'`` and
+        ``'maxsize'``.  If the cache is disabled `None` is returned.
+
+        .. versionadded:: 0.10
+        """
+        cache = self._match_cache
+        if cache is None:
+            return None
+        return {
+            'hits':         cache.hits,
+            'misses':       cache.misses,
+            'evictions':    cache.evictions,
+            'size':         len(cache),
+            'maxsize':      cache.maxsize
+        }
+
+    def _match(self, domain_part, path_info, method):
+        """Matches the path info against the rules for the domain part and
+        returns the outcome as tuple in the form ``(kind, rule, values)``.
+        The `kind` is one of the following strings:
+
+        ``'match'``
+            `rule` matched and `values` are the converted values.
+        ``'slash'``
+            `rule` requires a trailing slash that is missing.
+        ``'alias'``
+            `rule` is an alias, `values` are the converted values.
+        ``'redirect'``
+            another rule provides the defaults for `rule`.  `values` is a
+            tuple ``(domain_part, path)`` with the redirect target.
+        ``'method_not_allowed'``
+            `values` is a list of the methods that would match.
+        ``'not_found'``
+            nothing matched.
+
+        The outcome does not depend on the adapter so it can be cached.
+
+        :internal:
+        """
+        self.update()
+        if self.instrumentation is not None:
+            return self._match_instrumented(domain_part, path_info, method)
+        cache = self._match_cache
+        if cache is None:
+            return self._match_uncached(domain_part, path_info, method)
+
+        key = (domain_part, path_info, method)
+        rv = cache.get(key)
+        if rv is None:
+            rv = self._match_uncached(domain_part, path_info, method)
+            if self._is_cacheable(rv):
+                cache.set(key, rv)
+        kind, rule, values = rv
+        if kind in ('match', 'alias'):
+            # never hand out the cached dict itself
+            rv = kind, rule, dict(values)
+        return rv
+
+    def _match_instrumented(self, domain_part, path_info, method):
+        """Like :meth:`_match` but records the :class:`MatchStats` of the
+        match and passes them to the instrumentation callback.
+
+        :internal:
+        """
+        stats = MatchStats(domain_part, path_info, method)
+        start = default_timer()
+        cache = self._match_cache
+        rv = None
+        if cache is not None:
+            key = (domain_part, path_info, method)
+            rv = cache.get(key)
+            stats.cached = rv is not None
+        if rv is None:
+            rv = self._match_uncached(domain_part, path_info, method, stats)
+            if cache is not None and self._is_cacheable(rv):
+                cache.set(key, rv)
+        kind, rule, values = rv
+        if kind in ('match', 'alias') and cache is not None:
+            rv = kind, rule, dict(values)
+        stats.total_time = default_timer() - start
+        stats.kind = kind
+        stats.rule = rule
+        self.instrumentation(stats)
+        return rv
+
+    def _is_cacheable(self, rv):
+        """Checks if an outcome of :meth:`_match_uncached` can be cached.
+        The converted values of a match are shared by all requests served
+        from the cache, so they have to be immutable.
+
+        :internal:
+        """
+        kind, rule, values = rv
+        if kind in ('match', 'alias'):
+            return all(_is_immutable(value) for value in itervalues(values))
+        return True
+
+    def _match_uncached(self, domain_part, path_info, method, stats=None):
+        path_part = u'/' + path_info.lstrip(u'/')
+        path = domain_part + u'|' + path_part
+
+        have_match_for = set()
+        for rule in self._iter_candidates(domain_part, path_part, stats):
+            if stats is None:
+                # most candidates don't match, ruling them out right here
+                # saves a call per rule.  The rare rule that matches is
+                # searched again by :meth:`Rule._match`.
+                regex = rule._regex
+                if regex is not None and rule._path_matcher is None and \
+                   regex.search(path) is None:
+                    continue
+            else:
+                stats.rules_tried += 1
+            rv = rule._match(path, stats)
+            if rv is None:
+                continue
+            if rv is _slash_missing:
+                return 'slash', rule, None
+            if rule.alias and self.redirect_defaults:
+                return 'alias', rule, rv
+            if rule.methods is not None and method not in rule.methods:
+                have_match_for.update(rule.methods)
+                continue
+
+            if self.redirect_defaults and id(rule) in self._default_redirects:
+                if stats is None:
+                    redirect = self._get_default_redirect(rule, method, rv)
+                else:
+                    start = default_timer()
+                    redirect = self._get_default_redirect(rule, method, rv)
+                    stats.default_redirect_time += default_timer() - start
+                if redirect is not None:
+                    return 'redirect', rule, redirect
+
+            if self.reorder_interval and rule.arguments:
+                self._count_hit(rule)
+            return 'match', rule, rv
+
+        if have_match_for:
+            return 'method_not_allowed', None, list(have_match_for)
+        return 'not_found', None, None
+
+    def _count_hit(self, rule):
+        """Counts a match of a rule with converters and reorders the rules
+        every :attr:`reorder_interval` matches.  The lock only picks the
+        thread that reorders, matching never waits for it.
+
+        :internal:
+        """
+        hits = self._rule_hits
+        hits[id(rule)] = hits.get(id(rule), 0) + 1
+        self._hits_since_reorder += 1
+        if self._hits_since_reorder < self.reorder_interval or \
+           not self._reorder_lock.acquire(False):
+            return
+        try:
+            self._hits_since_reorder = 0
+            rules = self._order_by_hits()
+            old_rules = self._matcher.rules
+            if len(rules) != len(old_rules) or \
+               any(a is not b for a, b in zip(rules, old_rules)):
+                if hasattr(self._matcher, 'reorder'):
+                    self._matcher.reorder(rules)
+                else:
+                    self._replace_matcher(rules)
+            for key in list(hits):
+                hits[key] //= 2
+        finally:
+            self._reorder_lock.release()
+
+    def _replace_matcher(self, rules):
+        """Creates a new matcher for the rules and replaces the old one with
+        it.  Other threads keep matching with the old matcher until then
+        instead of seeing one that is filled halfway.
+
+        :internal:
+        """
+        matcher = self._matcher.__class__(self)
+        matcher.update(rules)
+        self._matcher = matcher
+
+    def _order_by_hits(self):
+        """Returns the rules with converters in matching order, but sorted
+        by their hits within runs of rules that can never match the same
+        URL.
+
+        :internal:
+        """
+        hits = self._rule_hits
+        rv = []
+        for run in self._disjoint_runs:
+            if len(run) > 1:
+                run = sorted(run, key=lambda x: -hits.get(id(x), 0))
+            rv.extend(run)
+        return rv
+
+    def _get_default_redirect(self, rule, method, values):
+        """Returns the domain part and path of the rule that provides
+        the defaults for a matched rule, or `None`.
+
+        :internal:
+        """
+        # only the rules that come before this one can provide the defaults,
+        # those are looked up by update.
+        item = self._default_redirects.get(id(rule))
+        if item is None:
+            return
+        providers, count = item
+        for r in islice(providers, count):
+            if r != rule and r.suitable_for(values, method):
+                values.update(r.defaults)
+                return r.build(values)
+
+    def _get_build_candidates(self, endpoint, keys, method):
+        """Returns the rules of an endpoint that are suitable for building
+        with values for the given set of keys and the method (see
+        :meth:`Rule.suitable_for`).  The result is a tuple of
+        ``(rule, defaults)`` items where `defaults` are the default values of
+        the rule that also appear in the keys.  Those still have to be equal
+        to the passed values.  The candidates are remembered until the rules
+        of the map change.
+
+        :internal:
+        """
+        cache_key = (endpoint, keys, method)
+        rv = self._build_candidates.get(cache_key)
+        if rv is not None:
+            return rv
+
+        rv = []
+        for rule in self._rules_by_endpoint.get(endpoint, ()):
+            if method is not None and rule.methods is not None \
+               and method not in rule.methods:
+                continue
+            defaults = rule.defaults or {}
+            for key in rule.arguments:
+                if key not in defaults and key not in keys:
+                    break
+            else:
+                rv.append((rule, tuple((key, value) for key, value
+                                       in iteritems(defaults)
+                                       if key in keys)))
+        rv = tuple(rv)
+
+        # the keys come from the application so don't let this grow
+        # without bounds.
+        if len(self._build_candidates) >= 1024:
+            self._build_candidates.clear()
+        self._build_candidates[cache_key] = rv
+        return rv
+
+    def _iter_candidates(self, domain_part, path, stats=None):
+        """Returns an iterable of the rules that could match the domain part
+        and path in matching order.  Called by :meth:`MapAdapter.match`
+        after :meth:`update`.  This returns the lists of the indexes and
+        the matcher instead of yielding from them, every rule passed on by
+        a generator adds up for maps the indexes can't narrow down.
+
+        :internal:
+        """
+        # rule regular expressions end with a dollar sign which also matches
+        # before a trailing newline.  Apart from that a static rule only
+        # matches its path or, depending on the slash settings, the path
+        # with a trailing slash.
+        key = path
+        if key[-1:] == u'\n':
+            key = key[:-1]
+        if key[-1:] == u'/':
+            key = key[:-1]
+        static = self._static_rules.get((domain_part, key))
+
+        # the rules with converters can only match if their first path
+        # segment is static and equal to the one of the path, or if it
+        # contains a converter.  If no rule starts with the segment of the
+        # path only the latter are tried.
+        if u'|' not in domain_part:
+            end = key.find(u'/', 1)
+            segment = end == -1 and key[1:] or key[1:end]
+            segments, rules = self._first_segments.get(
+                domain_part, self._first_segments[None])
+            if segment not in segments:
+                return static and chain(static, rules) or rules
+        if stats is None:
+            candidates = self._matcher.iter_candidates(domain_part, path)
+        else:
+            candidates = self._matcher.iter_candidates(domain_part, path,
+                                                       stats)
+        return static and chain(static, candidates) or candidates
+
+    def __getstate__(self):
+        # locks can't be pickled, :meth:`__setstate__` creates new ones.
+        state = self.__dict__.copy()
+        del state['_update_lock'], state['_reorder_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._update_lock = Lock()
+        self._reorder_lock = Lock()
+        # the indexes and the hit counts are keyed by the ids of the rules
+        # which are different for the copies, so everything is rebuilt.
+        self._rule_hits = {}
+        self._hits_since_reorder = 0
+        self._added = None
+        self._remap = True
+
     def __repr__(self):
         rules = self.iter_rules()
         return '%s(%s)' % (self.__class__.__name__, pformat(list(rules)))
 
 
+class MatchResult(object):
+    """The result of matching a URL as returned by :meth:`MapAdapter.resolve`
+    and :meth:`MapAdapter.match_many`.
+
+    .. versionadded:: 0.10
+
+    .. attribute:: kind
+
+       ``'match'`` if a rule matched, ``'redirect'`` if the URL has to be
+       redirected, ``'method_not_allowed'`` if rules only matched for
+       other methods and ``'not_found'`` if nothing matched.
+       :meth:`MapAdapter.match_many` returns ``'error'`` if a URL matched
+       but building its redirect URL raised an exception.
+
+    .. attribute:: rule
+
+       the rule that matched or caused the redirect, otherwise `None`.
+
+    .. attribute:: values
+
+       a dict with the converted values if a rule matched.
+
+    .. attribute:: redirect_to
+
+       the URL to redirect to for redirects.
+
+    .. attribute:: valid_methods
+
+       the list of methods that would have matched if the method was not
+       allowed.
+
+    .. attribute:: error
+
+       the exception that was raised for errors, for example a
+       :exc:`BuildError` if an alias has no URL for the matched values.
+    """
+    __slots__ = ('kind', 'rule', 'values', 'redirect_to', 'valid_methods',
+                 'error')
+    __getstate__ = _get_slots_state
+    __setstate__ = _set_slots_state
+
+    def __init__(self, kind, rule=None, values=None, redirect_to=None,
+                 valid_methods=None, error=None):
+        self.kind = kind
+        self.rule = rule
+        self.values = values
+        self.redirect_to = redirect_to
+        self.valid_methods = valid_methods
+        self.error = error
+
+    @property
+    def endpoint(self):
+        """The endpoint of the rule or `None`."""
+        if self.rule is not None:
+            return self.rule.endpoint
+
+    def __repr__(self):
+        return '<%s %s %r>' % (
+            self.__class__.__name__,
+            self.kind,
+            self.error or self.redirect_to or self.valid_methods or
+            self.endpoint
+        )
+
+
 class MapAdapter(object):
     """Returned by :meth:`Map.bind` or :meth:`Map.bind_to_environ` and does
     the URL matching and building based on runtime information.
     """
+    __slots__ = ('map', 'server_name', 'script_name', 'subdomain',
+                 'url_scheme', 'path_info', 'default_method', 'query_args')
+    __getstate__ = _get_slots_state
+    __setstate__ = _set_slots_state
 
     def __init__(self, map, server_name, script_name, subdomain,
                  url_scheme, path_info, default_method, query_args=None):
@@ -1391,65 +3598,206 @@ class MapAdapter(object):
         .. versionchanged:: 0.8
            `query_args` can now also be a string.
         """
-        self.map.update()
         if path_info is None:
             path_info = self.path_info
         else:
             path_info = to_unicode(path_info, self.map.charset)
-        if query_args is None:
-            query_args = self.query_args
         method = (method or self.default_method).upper()
 
-        path = u'%s|/%s' % (self.map.host_matching and self.server_name or
-                            self.subdomain, path_info.lstrip('/'))
+        domain_part = u'%s' % (self.map.host_matching and self.server_name or
+                               self.subdomain)
+        kind, rule, rv = self.map._match(domain_part, path_info, method)
+        if kind == 'match' and rule.redirect_to is None:
+            if return_rule:
+                return rule, rv
+            return rule.endpoint, rv
+        return self._finish_match(self._make_result(
+            kind, rule, rv, path_info, method, query_args), return_rule)
 
-        have_match_for = set()
-        for rule in self.map._rules:
-            try:
-                rv = rule.match(path)
-            except RequestSlash:
-                raise RequestRedirect(self.make_redirect_url(
-                    url_quote(path_info, self.map.charset,
-                              safe='/:|+') + '/', query_args))
-            except RequestAliasRedirect as e:
-                raise RequestRedirect(self.make_alias_redirect_url(
-                    path, rule.endpoint, e.matched_values, method, query_args))
-            if rv is None:
-                continue
-            if rule.methods is not None and method not in rule.methods:
-                have_match_for.update(rule.methods)
-                continue
+    def resolve(self, path_info=None, method=None, query_args=None):
+        """Works like :meth:`match` but returns a :class:`MatchResult`
+        instead of raising exceptions for redirects and URLs that do not
+        match.  This is cheaper for applications that get a lot of requests
+        for missing URLs:
 
-            if self.map.redirect_defaults:
-                redirect_url = self.get_default_redirect(rule, method, rv,
-                                                         query_args)
-                if redirect_url is not None:
-                    raise RequestRedirect(redirect_url)
-
-            if rule.redirect_to is not None:
-                if isinstance(rule.redirect_to, string_types):
-                    def _handle_match(match):
-                        value = rv[match.group(1)]
-                        return rule._converters[match.group(1)].to_url(value)
-                    redirect_url = _simple_rule_re.sub(_handle_match,
-                                                       rule.redirect_to)
-                else:
-                    redirect_url = rule.redirect_to(self, **rv)
-                raise RequestRedirect(str(url_join('%s://%s%s%s' % (
-                    self.url_scheme,
-                    self.subdomain and self.subdomain + '.' or '',
-                    self.server_name,
-                    self.script_name
-                ), redirect_url)))
+        >>> m = Map([
+        ...     Rule('/', endpoint='index'),
+        ...     Rule('/downloads/', endpoint='downloads/index')
+        ... ])
+        >>> urls = m.bind("example.com", "/")
+        >>> urls.resolve("/")
+        <MatchResult match 'index'>
+        >>> urls.resolve("/downloads")
+        <MatchResult redirect 'http://example.com/downloads/'>
+        >>> urls.resolve("/missing")
+        <MatchResult not_found None>
+
+        .. versionadded:: 0.10
+
+        :param path_info: the path info to use for matching.  Overrides the
+                          path info specified on binding.
+        :param method: the HTTP method used for matching.  Overrides the
+                       method specified on binding.
+        :param query_args: optional query arguments that are used for
+                           automatic redirects as string or dictionary.
+        """
+        if path_info is None:
+            path_info = self.path_info
+        else:
+            path_info = to_unicode(path_info, self.map.charset)
+        method = (method or self.default_method).upper()
 
+        domain_part = u'%s' % (self.map.host_matching and self.server_name or
+                               self.subdomain)
+        kind, rule, rv = self.map._match(domain_part, path_info, method)
+        return self._make_result(kind, rule, rv, path_info, method,
+                                 query_args)
+
+    def _make_result(self, kind, rule, rv, path_info, method, query_args):
+        """Turns the outcome of :meth:`Map._match` into a
+        :class:`MatchResult`.
+
+        :internal:
+        """
+        if kind == 'not_found':
+            return MatchResult(kind)
+        if kind == 'method_not_allowed':
+            return MatchResult(kind, valid_methods=list(rv))
+        redirect_url = self._get_redirect_url(kind, rule, rv, path_info,
+                                              method, query_args)
+        if redirect_url is not None:
+            return MatchResult('redirect', rule, redirect_to=redirect_url)
+        return MatchResult(kind, rule, rv)
+
+    def _finish_match(self, result, return_rule):
+        """Turns a :class:`MatchResult` into the return value or exception
+        of :meth:`match`.
+
+        :internal:
+        """
+        kind = result.kind
+        if kind == 'match':
             if return_rule:
-                return rule, rv
+                return result.rule, result.values
+            return result.rule.endpoint, result.values
+        if kind == 'redirect':
+            raise RequestRedirect(result.redirect_to)
+        if kind == 'method_not_allowed':
+            raise MethodNotAllowed(valid_methods=result.valid_methods)
+        raise NotFound()
+
+    def _get_redirect_url(self, kind, rule, rv, path_info, method,
+                          query_args):
+        """Returns the URL to redirect to for an outcome of
+        :meth:`Map._match` or `None` if it's not a redirect.
+
+        :internal:
+        """
+        if query_args is None:
+            query_args = self.query_args
+
+        if kind == 'match':
+            if rule.redirect_to is None:
+                return None
+            if isinstance(rule.redirect_to, string_types):
+                def _handle_match(match):
+                    value = rv[match.group(1)]
+                    return rule._converters[match.group(1)].to_url(value)
+                redirect_url = _simple_rule_re.sub(_handle_match,
+                                                   rule.redirect_to)
             else:
-                return rule.endpoint, rv
+                redirect_url = rule.redirect_to(self, **rv)
+            return str(url_join('%s://%s%s%s' % (
+                self.url_scheme,
+                self.subdomain and self.subdomain + '.' or '',
+                self.server_name,
+                self.script_name
+            ), redirect_url))
+
+        if kind == 'slash':
+            return self.make_redirect_url(
+                url_quote(path_info, self.map.charset,
+                          safe='/:|+') + '/', query_args)
+        if kind == 'alias':
+            path = u'%s|/%s' % (self.map.host_matching and self.server_name or
+                                self.subdomain, path_info.lstrip('/'))
+            return self.make_alias_redirect_url(
+                path, rule.endpoint, rv, method, query_args)
+        if kind == 'redirect':
+            redirect_domain_part, redirect_path = rv
+            return self.make_redirect_url(
+                redirect_path, query_args, domain_part=redirect_domain_part)
+
+    def match_many(self, paths, method=None):
+        """Matches a lot of URLs, for example from an access log, without
+        raising exceptions.  The paths are matched one after another while
+        they are consumed and a :class:`MatchResult` is yielded for each of
+        them:
 
-        if have_match_for:
-            raise MethodNotAllowed(valid_methods=list(have_match_for))
-        raise NotFound()
+        >>> m = Map([
+        ...     Rule('/', endpoint='index'),
+        ...     Rule('/downloads/', endpoint='downloads/index')
+        ... ])
+        >>> urls = m.bind("example.com", "/")
+        >>> for result in urls.match_many(['/', '/downloads', '/missing']):
+        ...     print(result)
+        <MatchResult match 'index'>
+        <MatchResult redirect 'http://example.com/downloads/'>
+        <MatchResult not_found None>
+
+        Instead of a path an item can also be a tuple in the form
+        ``(domain_part, path)`` where the domain part is the subdomain, or
+        the host if host matching is enabled.  The adapters needed to
+        build redirect URLs for other domains are created once per domain.
+        If building the redirect URL for a path raises an exception, an
+        ``'error'`` result with the exception is yielded for it and the
+        remaining paths are still matched.
+
+        .. versionadded:: 0.10
+
+        :param paths: an iterable of paths or ``(domain_part, path)``
+                      tuples.
+        :param method: the HTTP method used for matching.  Overrides the
+                       method specified on binding.
+        """
+        method = (method or self.default_method).upper()
+        host_matching = self.map.host_matching
+        default_domain_part = u'%s' % (host_matching and self.server_name or
+                                       self.subdomain)
+        adapters = {default_domain_part: self}
+
+        for item in paths:
+            if isinstance(item, tuple):
+                domain_part, path_info = item
+                if host_matching:
+                    domain_part = _encode_idna(domain_part.lower())
+                domain_part = u'%s' % to_unicode(domain_part)
+            else:
+                domain_part = default_domain_part
+                path_info = item
+            path_info = to_unicode(path_info, self.map.charset)
+
+            kind, rule, rv = self.map._match(domain_part, path_info, method)
+            if kind in ('not_found', 'method_not_allowed'):
+                yield self._make_result(kind, rule, rv, path_info, method,
+                                        None)
+                continue
+
+            adapter = adapters.get(domain_part)
+            if adapter is None:
+                adapter = adapters[domain_part] = self.__class__(
+                    self.map,
+                    host_matching and domain_part or self.server_name,
+                    self.script_name,
+                    not host_matching and domain_part or None,
+                    self.url_scheme, self.path_info, self.default_method,
+                    self.query_args)
+            try:
+                result = adapter._make_result(kind, rule, rv, path_info,
+                                              method, None)
+            except Exception as e:
+                result = MatchResult('error', rule, error=e)
+            yield result
 
     def test(self, path_info=None, method=None):
         """Test if a rule would match.  Works like `match` but returns `True`
@@ -1504,18 +3852,12 @@ class MapAdapter(object):
         :internal:
         """
         assert self.map.redirect_defaults
-        for r in self.map._rules_by_endpoint[rule.endpoint]:
-            # every rule that comes after this one, including ourself
-            # has a lower priority for the defaults.  We order the ones
-            # with the highest priority up for building.
-            if r is rule:
-                break
-            if r.provides_defaults_for(rule) and \
-               r.suitable_for(values, method):
-                values.update(r.defaults)
-                domain_part, path = r.build(values)
-                return self.make_redirect_url(
-                    path, query_args, domain_part=domain_part)
+        self.map.update()
+        rv = self.map._get_default_redirect(rule, method, values)
+        if rv is not None:
+            domain_part, path = rv
+            return self.make_redirect_url(
+                path, query_args, domain_part=domain_part)
 
     def encode_query_args(self, query_args):
         if not isinstance(query_args, string_types):
@@ -1563,8 +3905,13 @@ class MapAdapter(object):
 
         # default method did not match or a specific method is passed,
         # check all and go with first result.
-        for rule in self.map._rules_by_endpoint.get(endpoint, ()):
-            if rule.suitable_for(values, method):
+        candidates = self.map._get_build_candidates(
+            endpoint, frozenset(values), method)
+        for rule, defaults in candidates:
+            for key, value in defaults:
+                if value != values[key]:
+                    break
+            else:
                 rv = rule.build(values, append_unknown)
                 if rv is not None:
                     return rv
@@ -1651,3 +3998,105 @@ class MapAdapter(object):
             self.script_name[:-1],
             path.lstrip('/')
         ))
+
+    def build_many(self, endpoint, values_iterable, method=None,
+                   force_external=False, append_unknown=True):
+        """Builds URLs for one endpoint and an iterable of value dicts.
+        This works like calling :meth:`build` for each of the dicts but the
+        rules suitable for the names of the values and the host and prefix
+        of the URLs are only looked up once.  The URLs are built while the
+        values are consumed, which makes this useful for generating big
+        sitemaps:
+
+        >>> m = Map([Rule('/downloads/<int:id>', endpoint='downloads/show')])
+        >>> urls = m.bind("example.com", "/")
+        >>> list(urls.build_many("downloads/show", [{'id': 1}, {'id': 2}]))
+        ['/downloads/1', '/downloads/2']
+
+        If a URL cannot be built a `BuildError` is raised for it.
+
+        .. versionadded:: 0.10
+
+        :param endpoint: the endpoint of the URLs to build.
+        :param values_iterable: an iterable of dicts with the values for the
+                                URLs.
+        :param method: the HTTP method for the rule if there are different
+                       URLs for different methods on the same endpoint.
+        :param force_external: enforce full canonical external URLs.
+        :param append_unknown: unknown parameters are appended to the
+                               generated URL as query string argument.
+        """
+        self.map.update()
+        candidates_by_keys = {}
+        prefixes = {}
+
+        for values in values_iterable:
+            if values:
+                if isinstance(values, MultiDict):
+                    values = dict((k, v) for k, v
+                                  in values.iteritems(multi=True)
+                                  if v is not None)
+                else:
+                    for value in itervalues(values):
+                        if value is None:
+                            values = dict((k, v) for k, v
+                                          in iteritems(values)
+                                          if v is not None)
+                            break
+            else:
+                values = {}
+
+            keys = frozenset(values)
+            candidates = candidates_by_keys.get(keys)
+            if candidates is None:
+                candidates = self.map._get_build_candidates(endpoint, keys,
+                                                            method)
+                if method is None:
+                    candidates = self.map._get_build_candidates(
+                        endpoint, keys, self.default_method) + candidates
+                candidates_by_keys[keys] = candidates
+
+            for rule, defaults in candidates:
+                for key, value in defaults:
+                    if value != values[key]:
+                        break
+                else:
+                    rv = rule.build(values, append_unknown)
+                    if rv is not None:
+                        break
+            else:
+                raise BuildError(endpoint, values, method)
+            domain_part, path = rv
+
+            try:
+                prefix, relative = prefixes[domain_part]
+            except KeyError:
+                prefix, relative = prefixes[domain_part] = \
+                    self._get_build_prefix(domain_part, force_external)
+            path = path.lstrip('/')
+            # relative URLs are joined with the script name which resolves
+            # dot segments, so only those can be concatenated directly.
+            if relative and (prefix is None or path[:1] == '.' or
+                             '/.' in path):
+                yield str(url_join(self.script_name, './' + path))
+            else:
+                yield str(prefix + path)
+
+    def _get_build_prefix(self, domain_part, force_external):
+        """Returns a ``(prefix, relative)`` tuple for :meth:`build_many`.
+        The prefix is the string put in front of the paths for the domain
+        part or `None` if relative URLs always have to be joined with the
+        script name.
+
+        :internal:
+        """
+        host = self.get_host(domain_part)
+        if not force_external and (
+            (self.map.host_matching and host == self.server_name) or
+             (not self.map.host_matching and domain_part == self.subdomain)):
+            script_name = self.script_name
+            if script_name[:1] == '.' or '/.' in script_name:
+                return None, True
+            return script_name, True
+        return u'%s://%s%s/' % (self.url_scheme, host,
+                                self.script_name[:-1]), False
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""
+    routing_bench
+    ~~~~~~~~~~~~~
+
+    Benchmarks for the URL routing.  Synthetic URL maps of different sizes
+    are created and binding, matching and building is timed for them, and
+    the memory used per rule is measured.  The results are written as JSON
+    so that they can be compared between versions of the routing module::
+
+        $ python routing_bench.py -o before.json
+        $ python routing_bench.py -o after.json --compare before.json
+
+    By default the `routing` module next to this file is benchmarked, use
+    ``--module werkzeug.routing`` to benchmark the installed one.
+
+    :copyright: (c) 2014 by the Werkzeug Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import print_function
+
+import sys
+import json
+import random
+import platform
+from optparse import OptionParser
+from timeit import default_timer
+
+
+#: the sizes of the URL maps that are benchmarked by default
+DEFAULT_SIZES = (10, 100, 1000, 10000)
+
+_words = ['users', 'posts', 'files', 'tags', 'blog', 'shop', 'wiki',
+          'media', 'teams', 'jobs', 'docs', 'events']
+
+
+def make_rules(routing, size, seed=0, shared_prefix=False):
+    """Creates `size` rules with a mix of static rules, converters, branch
+    URLs, subdomains and method restrictions.  The first path segment of
+    every rule is unique unless `shared_prefix` is set.  Then all paths
+    start with ``/api/v1/`` to ``/api/v3/`` and some rules have converters
+    right after that, like ``/api/v1/<resource>/<int:id>/tags``.
+
+    Returns the list of rules and a dict with example requests for the
+    different outcomes of matching: ``'hit'``, ``'miss'``, ``'405'`` and
+    ``'redirect'`` are lists of ``(subdomain, path, method)`` tuples and
+    ``'build'`` is a list of ``(subdomain, endpoint, values)`` tuples.
+    """
+    Rule = routing.Rule
+    rnd = random.Random(seed)
+    rules = []
+    hit = []
+    not_allowed = []
+    redirect = []
+    build = []
+
+    def make_prefix(idx):
+        if shared_prefix:
+            return '/api/v%d/%s%d' % (idx % 3 + 1, rnd.choice(_words), idx)
+        return '/%s%d' % (rnd.choice(_words), idx)
+
+    for idx in range(size):
+        prefix = make_prefix(idx)
+        endpoint = 'endpoint%d' % idx
+        kind = idx % 10
+        subdomain = ''
+        if kind in (0, 1):
+            rule = Rule(prefix + '/about', endpoint=endpoint)
+            path, values = prefix + '/about', {}
+        elif kind == 2:
+            rule = Rule(prefix + '/', endpoint=endpoint)
+            path, values = prefix + '/', {}
+            redirect.append((subdomain, prefix, 'GET'))
+        elif kind == 3:
+            rule = Rule(prefix + '/<int:id>', endpoint=endpoint)
+            item_id = rnd.randint(1, 100000)
+            path, values = '%s/%d' % (prefix, item_id), {'id': item_id}
+        elif kind == 4:
+            rule = Rule(prefix + '/<int:id>/edit', endpoint=endpoint,
+                        methods=['GET', 'POST'])
+            item_id = rnd.randint(1, 100000)
+            path, values = '%s/%d/edit' % (prefix, item_id), {'id': item_id}
+        elif kind == 5:
+            rule = Rule(prefix + '/files/<path:filename>', endpoint=endpoint)
+            filename = 'static/css/site-%d.css' % idx
+            path, values = prefix + '/files/' + filename, \
+                {'filename': filename}
+        elif kind == 6 and shared_prefix:
+            version, tail = prefix[1:].split('/')[1:]
+            rule = Rule('/api/%s/<resource>/<int:id>/%s' % (version, tail),
+                        endpoint=endpoint)
+            resource = rnd.choice(_words)
+            item_id = rnd.randint(1, 100000)
+            path = '/api/%s/%s/%d/%s' % (version, resource, item_id, tail)
+            values = {'resource': resource, 'id': item_id}
+        elif kind == 6:
+            rule = Rule(prefix + '/<any(new, top, hot):sort>',
+                        endpoint=endpoint)
+            sort = rnd.choice(['new', 'top', 'hot'])
+            path, values = prefix + '/' + sort, {'sort': sort}
+        elif kind == 7:
+            rule = Rule(prefix + '/<uuid:key>', endpoint=endpoint)
+            key = '%08x-0000-4000-8000-%012x' % (idx, rnd.getrandbits(48))
+            path, values = prefix + '/' + key, {'key': key}
+        elif kind == 8:
+            subdomain = 'api'
+            rule = Rule(prefix + '/status/', endpoint=endpoint,
+                        subdomain=subdomain, strict_slashes=False)
+            path, values = prefix + '/status/', {}
+        else:
+            rule = Rule(prefix + '/submit', endpoint=endpoint,
+                        methods=['POST'])
+            path, values = prefix + '/submit', {}
+            not_allowed.append((subdomain, path, 'GET'))
+        rules.append(rule)
+        hit.append((subdomain, path, kind == 9 and 'POST' or 'GET'))
+        build.append((subdomain, endpoint, values))
+
+    miss = [('', make_prefix(idx) + '/missing/%d' % idx, 'GET')
+            for idx in range(max(size // 10, 1))]
+    rnd.shuffle(hit)
+    rnd.shuffle(build)
+    return rules, {
+        'hit':      hit,
+        'miss':     miss,
+        '405':      not_allowed,
+        'redirect': redirect,
+        'build':    build
+    }
+
+
+def percentile(timings, pct):
+    """Returns the percentile of a sorted list of timings."""
+    if not timings:
+        return None
+    idx = int(round(pct / 100.0 * (len(timings) - 1)))
+    return timings[idx]
+
+
+def summarize(timings):
+    """Turns a list of timings in seconds into a dict with the throughput
+    and latency percentiles in microseconds.
+    """
+    timings = sorted(timings)
+    total = sum(timings)
+    rv = {
+        'count':        len(timings),
+        'ops_per_sec':  total and len(timings) / total or None
+    }
+    for pct in 50, 90, 99:
+        rv['p%d_us' % pct] = percentile(timings, pct) * 1e6
+    rv['max_us'] = timings[-1] * 1e6
+    return rv
+
+
+def time_calls(func, args_list, iterations, expected=()):
+    """Calls `func` `iterations` times with the argument tuples from
+    `args_list` (cycling over them) and returns the timings.  Exceptions
+    listed in `expected` are part of the measured operation.
+    """
+    timings = []
+    add = timings.append
+    count = len(args_list)
+    for idx in range(iterations):
+        args = args_list[idx % count]
+        start = default_timer()
+        try:
+            func(*args)
+        except expected:
+            pass
+        add(default_timer() - start)
+    return timings
+
+
+def deep_sizeof(obj, seen):
+    """Returns the size of an object and everything it references that is
+    not in `seen` yet.  Shared objects are only counted once.
+    """
+    if id(obj) in seen or isinstance(obj, type):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_sizeof(key, seen) + deep_sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_sizeof(item, seen)
+    elif not callable(obj):
+        if hasattr(obj, '__dict__'):
+            size += deep_sizeof(obj.__dict__, seen)
+        for cls in type(obj).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if name not in ('__dict__', '__weakref__'):
+                    size += deep_sizeof(getattr(obj, name, None), seen)
+    return size
+
+
+def measure_memory(routing, size, map_options=None, shared_prefix=False):
+    """Returns a dict with the memory used per rule of a URL map with
+    `size` rules.  ``'rule_bytes'`` are the bytes of the rules themselves
+    (their attributes, compiled regular expressions and converters), and
+    ``'map_bytes'`` is everything allocated for the map divided by the
+    number of rules.  The latter needs :mod:`tracemalloc` and is `None`
+    if it's not available.
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+    try:
+        rules = make_rules(routing, size, shared_prefix=shared_prefix)[0]
+        map = routing.Map(rules, **(map_options or {}))
+        map.update()
+        map_bytes = None
+        if tracemalloc is not None:
+            map_bytes = float(tracemalloc.get_traced_memory()[0]) / size
+    finally:
+        if tracemalloc is not None:
+            tracemalloc.stop()
+    seen = set([id(map), id(None)])
+    rule_bytes = sum(deep_sizeof(rule, seen) for rule in rules)
+    return {
+        'rule_bytes':   float(rule_bytes) / size,
+        'map_bytes':    map_bytes
+    }
+
+
+def make_environ(subdomain, path, method):
+    """Creates a minimal WSGI environment for a request."""
+    return {
+        'wsgi.url_scheme':  'http',
+        'HTTP_HOST':        (subdomain and subdomain + '.' or '') +
+                            'example.com',
+        'SERVER_NAME':      'example.com',
+        'SERVER_PORT':      '80',
+        'SCRIPT_NAME':      '',
+        'PATH_INFO':        path,
+        'REQUEST_METHOD':   method
+    }
+
+
+def bench_size(routing, size, iterations, map_options=None,
+               shared_prefix=False):
+    """Benchmarks a URL map with `size` rules and returns a dict with the
+    results for the different operations.
+    """
+    rules, requests = make_rules(routing, size, shared_prefix=shared_prefix)
+    start = default_timer()
+    map = routing.Map(rules, **(map_options or {}))
+    map.update()
+    results = {'map_init': {'seconds': default_timer() - start}}
+
+    adapters = {}
+    for subdomain in '', 'api':
+        adapters[subdomain] = map.bind('example.com', subdomain=subdomain)
+
+    environs = [(make_environ(*request),) for request in requests['hit']]
+    results['bind_to_environ'] = summarize(time_calls(
+        map.bind_to_environ, environs, iterations))
+
+    def match(subdomain, path, method):
+        adapters[subdomain].match(path, method)
+    for name in 'hit', 'miss', '405', 'redirect':
+        if not requests[name]:
+            continue
+        results['match_' + name] = summarize(time_calls(
+            match, requests[name], iterations, routing.HTTPException))
+
+    def build(subdomain, endpoint, values):
+        adapters[subdomain].build(endpoint, values)
+    results['build'] = summarize(time_calls(
+        build, requests['build'], iterations))
+    results['memory'] = measure_memory(routing, size, map_options,
+                                       shared_prefix)
+    return results
+
+
+def run(routing, sizes=DEFAULT_SIZES, iterations=2000, map_options=None,
+        shared_prefix=False):
+    """Runs the benchmarks for all sizes and returns the report as dict."""
+    report = {
+        'module':       routing.__name__,
+        'module_file':  getattr(routing, '__file__', None),
+        'python':       platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'iterations':   iterations,
+        'map_options':  dict((key, getattr(value, '__name__', value))
+                             for key, value in
+                             (map_options or {}).items()),
+        'shared_prefix': shared_prefix,
+        'sizes':        {}
+    }
+    for size in sizes:
+        report['sizes'][str(size)] = bench_size(routing, size, iterations,
+                                                map_options, shared_prefix)
+    return report
+
+
+#: the values compared by :func:`compare`
+COMPARED_VALUES = ('p50_us', 'rule_bytes', 'map_bytes')
+
+
+def compare(report, baseline, threshold=0.1):
+    """Compares the median latencies and the memory usage of two reports and
+    returns a list of ``(size, name, baseline, current, change, mark)``
+    tuples.  Changes are relative and values that changed by more than
+    `threshold` are marked with ``'!'``.
+    """
+    rv = []
+    for size, results in sorted(report['sizes'].items(),
+                                key=lambda x: int(x[0])):
+        old_results = baseline['sizes'].get(size, {})
+        for operation, result in sorted(results.items()):
+            for key in COMPARED_VALUES:
+                old = old_results.get(operation, {}).get(key)
+                new = result.get(key)
+                if not old or new is None:
+                    continue
+                change = (new - old) / old
+                rv.append((int(size), '%s.%s' % (operation, key), old, new,
+                           change, abs(change) > threshold and '!' or ''))
+    return rv
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-m', '--module', default='routing',
+                      help='the routing module to benchmark')
+    parser.add_option('-s', '--sizes',
+                      default=','.join(map(str, DEFAULT_SIZES)),
+                      help='comma separated sizes of the URL maps')
+    parser.add_option('-n', '--iterations', type='int', default=2000,
+                      help='calls per operation and size')
+    parser.add_option('--matcher', help='name of the matcher class to use')
+    parser.add_option('--shared-prefix', action='store_true', default=False,
+                      help='let the rules share the prefixes /api/v1 to '
+                           '/api/v3 instead of unique first segments')
+    parser.add_option('-o', '--output', help='write the JSON report here')
+    parser.add_option('-c', '--compare', metavar='REPORT',
+                      help='compare with an earlier JSON report')
+    options, args = parser.parse_args(args)
+
+    routing = __import__(options.module, None, None, ['Map'])
+    map_options = {}
+    if options.matcher:
+        map_options['matcher'] = getattr(routing, options.matcher)
+    sizes = [int(x) for x in options.sizes.split(',') if x.strip()]
+    report = run(routing, sizes, options.iterations, map_options,
+                 options.shared_prefix)
+
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            f.write(data + '\n')
+        finally:
+            f.close()
+    else:
+        print(data)
+
+    if options.compare:
+        f = open(options.compare)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        for row in compare(report, baseline):
+            print('%6d  %-28s %12.2f %12.2f %+7.1f%% %s' %
+                  (row[:4] + (row[4] * 100,) + row[5:]), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()